@@ -0,0 +1,196 @@
+"""
+This module provides non-blocking communication with the SPARQL endpoint
+for use from an asyncio event loop.
+"""
+
+import asyncio
+import logging
+import time
+from io import BytesIO
+from rdflib.query import Result
+from fair_data_fund import rdf
+
+## Error handling for loading aiohttp is done in 'wsgi'.
+try:
+    import aiohttp
+    AIOHTTP_DEPENDENCY_LOADED = True
+except (ImportError, ModuleNotFoundError):
+    AIOHTTP_DEPENDENCY_LOADED = False
+
+class AsyncSparqlInterface:
+    """
+    This class is the asyncio counterpart of SparqlInterface.  It renders
+    queries and normalizes results using the SparqlInterface it wraps, and
+    shares its caches, but talks to the SPARQL endpoint without blocking.
+    It only implements the requests that the ASGI entry point handles in
+    the event loop; the others run in a thread pool on SparqlInterface.
+    """
+
+    def __init__ (self, db):
+        self.db      = db  # pylint: disable=invalid-name
+        self.log     = logging.getLogger(__name__)
+        self.session = None
+
+    def __log_query (self, query, prefix="Query"):
+        self.log.info ("%s:\n---\n%s\n---", prefix, query)
+
+    def __client_session (self):
+        """Returns the HTTP client session, which must be created inside the event loop."""
+        if self.session is None or self.session.closed:
+            connector    = aiohttp.TCPConnector (limit = max(self.db.connection_pool_size, 1))
+            self.session = aiohttp.ClientSession (connector = connector)
+        return self.session
+
+    async def __post (self, url, body, content_type, deadline=None):
+        """Returns the body and content type of the response for POSTing BODY to URL."""
+        headers = {
+            "Accept":       "application/sparql-results+json",
+            "Content-Type": content_type
+        }
+        timeout = None
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError ("The deadline of the SPARQL request has passed.")
+            timeout = aiohttp.ClientTimeout (total = remaining)
+
+        session = self.__client_session ()
+        async with session.post (url, data=body.encode("utf-8"), headers=headers,
+                                 timeout=timeout) as response:
+            response.raise_for_status ()
+            return await response.read (), response.content_type
+
+    async def __post_query (self, query, deadline=None, primary=False):
+        """
+        Returns the body and content type of the response for QUERY from a
+        read endpoint, or from the primary when PRIMARY is True.
+        """
+        balancer = self.db.read_balancer
+        if balancer is None:
+            return await self.__post (self.db.endpoint, query,
+                                      "application/sparql-query", deadline)
+
+        candidates = balancer.candidates (primary)
+        for index, endpoint in enumerate (candidates):
+            try:
+                response = await self.__post (endpoint, query,
+                                              "application/sparql-query", deadline)
+            except aiohttp.ClientError as error:
+                if (isinstance (error, aiohttp.ClientResponseError) and
+                    error.status < 500):
+                    raise
+                balancer.mark_down (endpoint)
+                if index == len(candidates) - 1:
+                    raise
+                continue
+
+            balancer.mark_up (endpoint)
+            return response
+
+        return None
+
+    async def run_query (self, query, template=None, primary=False):
+        """
+        Returns the normalized results for QUERY, True for updates, or [] on
+        failure.  TEMPLATE is the name under which the metrics of the query
+        are recorded.  With PRIMARY, a read query is not sent to a read
+        replica, which may not have caught up with the latest writes.
+        """
+        started = time.monotonic()
+        results = await self.__execute_query (query,
+                                              query_types = self.db.query_types.get (template),
+                                              primary     = primary)
+        if results is None:
+            self.db.record_query_metrics (query, template, started, failed=True)
+            return []
+
+        rows = len(results) if isinstance (results, list) else None
+        self.db.record_query_metrics (query, template, started, rows)
+        return results
+
+    async def __execute_query (self, query, attempt=0, deadline=None, query_types=None,
+                               primary=False):
+        """
+        Returns the normalized results for QUERY, True for updates, or None on
+        failure.  QUERY_TYPES is used instead of rdf.query_type when it is set.
+        """
+
+        if attempt == 0:
+            deadline = self.db.query_deadline ()
+
+        execution_type, query_type = query_types or rdf.query_type (query)
+        try:
+            if execution_type == "update":
+                await self.__post (self.db.update_endpoint, query,
+                                   "application/sparql-update; charset=UTF-8",
+                                   deadline)
+                if self.db.read_balancer is not None:
+                    self.db.read_balancer.record_write ()
+                self.db.audit_query (query)
+                return True
+
+            if execution_type == "gather":
+                body, content_type = await self.__post_query (query, deadline, primary)
+                query_results = Result.parse (BytesIO (body), content_type=content_type)
+                if query_type == "ASK":
+                    return query_results.askAnswer
+                return list(map(self.db.row_normalizer (), query_results.bindings))
+
+            self.log.error ("Invalid query (%s, %s)", execution_type, query_type)
+            self.__log_query (query)
+
+        except aiohttp.ClientResponseError as error:
+            if error.status == 503:
+                delay = self.db.backoff_delay (attempt, deadline)
+                if delay is not None:
+                    self.log.warning ("Retrying SPARQL request in %.2f seconds due to "
+                                      "service unavailability (%d/%d)",
+                                      delay, attempt + 1, self.db.query_retries)
+                    await asyncio.sleep (delay)
+                    return await self.__execute_query (query, attempt + 1, deadline,
+                                                       query_types, primary)
+
+            self.log.error ("SPARQL endpoint returned %d:\n---\n%s\n---",
+                            error.status, error.message)
+            if error.status == 400:
+                self.__log_query (query)
+        except asyncio.TimeoutError:
+            self.log.error ("SPARQL query exceeded the deadline of %s seconds.",
+                            self.db.query_timeout)
+            self.__log_query (query)
+        except aiohttp.ClientError as error:
+            self.log.error ("Connection to the SPARQL endpoint failed: %s", error)
+
+        return None
+
+    async def close (self):
+        """Procedure to close the connections to the SPARQL endpoint."""
+        if self.session is not None:
+            await self.session.close ()
+            self.session = None
+
+    async def update_application (self, application_uuid, submitted=False, **fields):
+        """
+        Returns True when the application identified by APPLICATION_UUID has
+        been updated, False otherwise.
+        """
+        # The write-behind queue only keeps drafts in memory.
+        if self.db.write_behind is not None and not submitted:
+            return self.db.update_application (application_uuid, submitted=submitted, **fields)
+
+        # The stored values decide which fields are written, so they must
+        # not come from a replica that has not caught up yet.
+        rows    = await self.run_query (self.db.application_fields_query (application_uuid),
+                                        "application_fields", primary=True)
+        current = self.db.application_field_values (rows)
+        query   = self.db.update_application_query (application_uuid, fields, submitted,
+                                                    current = current)
+        if query is None:
+            return True
+
+        template = "update_application" if current is None else "update_application_fields"
+        if not await self.run_query (query, template):
+            return False
+
+        self.db.invalidate_application_cache (application_uuid)
+        return True
@@ -0,0 +1,533 @@
+"""
+This module replays the journeys of applicants and reviewers against a
+WebUserInterfaceServer, to measure throughput and latency in a way that
+can be compared across commits.  The server runs in-process, either on
+the in-memory RDF store or on the stand-in SPARQL endpoint, so no
+network access or Virtuoso is needed.
+
+Run it with: python -m fair_data_fund.benchmark --output results.json
+"""
+
+import argparse
+import http.client
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from http.cookies import SimpleCookie
+from rdflib import Literal, XSD
+from werkzeug.serving import make_server
+from werkzeug.test import Client
+from fair_data_fund import rdf, sparql_standin, wsgi
+from fair_data_fund.convenience import add_logging_level
+
+## The journeys in the order they are replayed.  Each journey depends on
+## the applications created and submitted by the journeys before it.
+JOURNEYS = ("create_application", "autosave", "upload_budget", "submit",
+            "review_dashboard", "evaluate", "ranking")
+
+REVIEWER_EMAIL = "reviewer@benchmark.invalid"
+
+class JourneyFailed (Exception):
+    """Raised when a response does not have the expected status code."""
+
+def percentile (sorted_values, fraction):
+    """Returns the nearest-rank FRACTION percentile of SORTED_VALUES."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round (fraction * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def latency_summary (values):
+    """Returns the mean, maximum and p50, p95 and p99 of VALUES in seconds."""
+    values = sorted (values)
+    if not values:
+        return None
+    return {
+        "mean": sum(values) / len(values),
+        "max":  values[-1],
+        "p50":  percentile (values, 0.50),
+        "p95":  percentile (values, 0.95),
+        "p99":  percentile (values, 0.99)
+    }
+
+class TestClientTransport:
+    """This class sends requests to the server through werkzeug's test client."""
+
+    name = "test-client"
+
+    def __init__ (self, server):
+        self.server = server
+        self.local  = threading.local()
+
+    def start (self):
+        """Procedure to prepare the transport for sending requests."""
+
+    def stop (self):
+        """Procedure to release the resources of the transport."""
+
+    def request (self, method, path, headers, body=None):
+        """Returns the status code, headers and body of the response."""
+        client = getattr (self.local, "client", None)
+        if client is None:
+            client = Client (self.server, use_cookies=False)
+            self.local.client = client
+
+        response = client.open (path, method=method, headers=headers, data=body,
+                                environ_base={"REMOTE_ADDR": "127.0.0.1"})
+        return response.status_code, response.headers, response.get_data ()
+
+class SocketTransport:
+    """
+    This class serves the server on a local socket with werkzeug's threaded
+    server, and sends requests over kept-alive HTTP connections.
+    """
+
+    name = "socket"
+
+    def __init__ (self, server):
+        self.http_server = make_server ("127.0.0.1", 0, server, threaded=True)
+        self.thread      = None
+        self.local       = threading.local()
+
+    def start (self):
+        """Procedure to serve requests from a background thread."""
+        self.thread = threading.Thread (target = self.http_server.serve_forever,
+                                        name   = "benchmark-server",
+                                        daemon = True)
+        self.thread.start()
+
+    def stop (self):
+        """Procedure to stop serving and close the socket."""
+        self.http_server.shutdown ()
+        self.http_server.server_close ()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def request (self, method, path, headers, body=None):
+        """Returns the status code, headers and body of the response."""
+        connection = getattr (self.local, "connection", None)
+        if connection is None:
+            connection = http.client.HTTPConnection ("127.0.0.1", self.http_server.port)
+            self.local.connection = connection
+
+        try:
+            connection.request (method, path, body=body, headers=headers)
+            response = connection.getresponse ()
+        except (http.client.HTTPException, OSError):
+            # The server closed the kept-alive connection; retry on a new one.
+            connection.close ()
+            connection.request (method, path, body=body, headers=headers)
+            response = connection.getresponse ()
+        return response.status, response.headers, response.read ()
+
+class Benchmark:
+    """
+    This class replays 'iterations' journeys of each type in JOURNEYS with
+    'concurrency' concurrent clients, and records the latency of every
+    journey and of every request in it.
+    """
+
+    def __init__ (self, server, transport, iterations=20, concurrency=1, autosave_burst=10):
+        self.server         = server
+        self.transport      = transport
+        self.iterations     = iterations
+        self.concurrency    = concurrency
+        self.autosave_burst = autosave_burst
+        self.applications   = [None] * iterations
+        self.session_cookie = None
+        self.institution    = None
+        self.budget         = b""
+        self.lock           = threading.Lock()
+        self.results        = {}
+        self.log            = logging.getLogger(__name__)
+
+    def __record (self, journey, key, value):
+        with self.lock:
+            self.results[journey][key].append (value)
+
+    def __request (self, journey, method, path, expected_status, headers=None, body=None):
+        """Returns the headers and body of the response after recording its latency."""
+        headers = { **(headers or {}) }
+        if self.session_cookie is not None:
+            headers["Cookie"] = self.session_cookie
+
+        start = time.perf_counter()
+        status, response_headers, response_body = self.transport.request (method, path,
+                                                                           headers, body)
+        self.__record (journey, "requests", time.perf_counter() - start)
+        if status != expected_status:
+            raise JourneyFailed (f"{method} {path} returned {status}, expected {expected_status}.")
+        return response_headers, response_body
+
+    def __json_request (self, journey, method, path, record, expected_status):
+        return self.__request (journey, method, path, expected_status,
+                               headers = { "Content-Type": "application/json",
+                                           "Accept":       "application/json" },
+                               body    = json.dumps (record).encode("utf-8"))
+
+    def __application_record (self, index, words=200):
+        text = " ".join (["FAIR"] * words)
+        return {
+            "name":               f"Applicant {index}",
+            "email":              f"applicant-{index}@benchmark.invalid",
+            "institution":        self.institution,
+            "faculty":            "Faculty of Benchmarking",
+            "department":         "Department of Latency",
+            "position":           "Researcher",
+            "discipline":         "Computer Science",
+            "datatype":           "Measurements",
+            "description":        text,
+            "size":               "10 GB",
+            "whodoesit":          text,
+            "achievement":        text,
+            "fair_summary":       text,
+            "findable":           text,
+            "accessible":         text,
+            "interoperable":      text,
+            "reusable":           text,
+            "summary":            text,
+            "promotion":          text,
+            "linked_publication": "yes",
+            "data_timing":        "recent",
+            "refinement":         "additional-data",
+            "consent_to_interview":    True,
+            "consent_to_checkpoints":  True,
+            "consent_to_financial":    True,
+            "consent_to_organization": True
+        }
+
+    def journey_create_application (self, index):
+        """Procedure to start a new application and load its form."""
+        headers, _ = self.__request ("create_application", "GET", "/application-form", 302,
+                                     headers = { "Accept": "text/html" })
+        uuid = headers.get ("Location", "").split("/")[-1]
+        self.__request ("create_application", "GET", f"/application-form/{uuid}", 200,
+                        headers = { "Accept": "text/html" })
+        self.applications[index] = uuid
+
+    def journey_autosave (self, index):
+        """Procedure to save a form the way the browser does while typing."""
+        uuid = self.applications[index]
+        for step in range(1, self.autosave_burst + 1):
+            record = self.__application_record (index, words = step * 20)
+            self.__json_request ("autosave", "PUT", f"/application-form/{uuid}", record, 204)
+
+    def journey_upload_budget (self, index):
+        """Procedure to upload the budget template for an application."""
+        uuid     = self.applications[index]
+        boundary = f"benchmark-{index:08d}"
+        body     = (f"--{boundary}\r\n"
+                    "Content-Disposition: form-data; name=\"file\"; "
+                    "filename=\"Budget.xlsx\"\r\n"
+                    "Content-Type: application/octet-stream\r\n"
+                    "\r\n").encode("utf-8") + self.budget + f"\r\n--{boundary}--\r\n".encode("utf-8")
+        self.__request ("upload_budget", "POST", f"/application-form/{uuid}/upload-budget", 201,
+                        headers = { "Content-Type":   f"multipart/form-data; boundary={boundary}",
+                                    "Content-Length": str(len(body)),
+                                    "Accept":         "application/json" },
+                        body    = body)
+
+    def journey_submit (self, index):
+        """Procedure to submit an application and load the confirmation."""
+        uuid = self.applications[index]
+        self.__json_request ("submit", "PUT", f"/application-form/{uuid}/submit",
+                             self.__application_record (index), 200)
+        self.__request ("submit", "GET", f"/application-form/{uuid}/submit", 200,
+                        headers = { "Accept": "text/html" })
+
+    def journey_review_dashboard (self, index):  # pylint: disable=unused-argument
+        """Procedure to load the dashboard of a reviewer."""
+        self.__request ("review_dashboard", "GET", "/review/dashboard", 200,
+                        headers = { "Accept": "text/html" })
+
+    def journey_evaluate (self, index):
+        """Procedure to open and evaluate an application."""
+        uuid = self.applications[index]
+        self.__request ("evaluate", "GET", f"/review/{uuid}", 200,
+                        headers = { "Accept": "text/html" })
+        scores = { "refinement": index % 5, "findable": 3, "accessible": 2,
+                   "interoperable": 4, "reusable": 1, "budget": 3, "achievement": 2,
+                   "comments": "Evaluated by the benchmark." }
+        self.__json_request ("evaluate", "PUT", f"/review/{uuid}", scores, 204)
+
+    def journey_ranking (self, index):  # pylint: disable=unused-argument
+        """Procedure to load the ranking, which must list the evaluated applications."""
+        _, body = self.__request ("ranking", "GET", "/ranking", 200,
+                                  headers = { "Accept": "text/html" })
+        if body.count (b"<tr>") == 0:
+            raise JourneyFailed ("The ranking lists no applications.")
+
+    def assign_anonymous_names (self):
+        """
+        Returns True after giving the applications the anonymous names under
+        which reviewers see them.  These are assigned outside the website, and
+        the ranking only lists applications that have one.
+        """
+        graph = rdf.TripleBuilder ()
+        for index, uuid in enumerate (self.applications):
+            if uuid is not None:
+                graph.add (rdf.uuid_to_uri (uuid, "application"), rdf.FDF["anon_name"],
+                           f"Application {index + 1:04d}", XSD.string)
+
+        if len(graph) == 0:
+            return True
+
+        if not self.server.db.add_triples_from_graph (graph):
+            self.log.error ("Assigning the anonymous names failed.")
+            return False
+
+        for uuid in self.applications:
+            if uuid is not None:
+                self.server.db.invalidate_application_cache (uuid)
+        return True
+
+    def prepare (self):
+        """Returns True after logging in the reviewer and finding an institution."""
+        institutions = self.server.db.institutions ()
+        if not institutions:
+            self.log.error ("The RDF store holds no institutions.")
+            return False
+        self.institution = institutions[0]["uuid"]
+
+        budget_path = os.path.join (os.path.dirname (__file__), "resources", "static",
+                                    "Budget_Template_FAIR_Data_Fund_2024.xlsx")
+        with open (budget_path, "rb") as budget_file:
+            self.budget = budget_file.read ()
+
+        status, headers, _ = self.transport.request ("GET", "/login", { "Accept": "text/html" })
+        cookie = SimpleCookie (headers.get ("Set-Cookie", ""))
+        if status != 302 or self.server.cookie_key not in cookie:
+            self.log.error ("Logging in the reviewer failed with status %d.", status)
+            return False
+        self.session_cookie = f"{self.server.cookie_key}={cookie[self.server.cookie_key].value}"
+        return True
+
+    def __run_journey (self, journey, index):
+        start = time.perf_counter()
+        try:
+            getattr (self, f"journey_{journey}") (index)
+        except JourneyFailed as error:
+            self.log.error ("Journey '%s' %d failed: %s", journey, index, error)
+            with self.lock:
+                self.results[journey]["errors"] += 1
+            return None
+        self.__record (journey, "journeys", time.perf_counter() - start)
+        return None
+
+    def run (self):
+        """Returns the results per journey after replaying all of them."""
+        for journey in JOURNEYS:
+            self.results[journey] = { "journeys": [], "requests": [], "errors": 0 }
+            indexes = [index for index, uuid in enumerate (self.applications)
+                       if uuid is not None or journey == "create_application"]
+            start = time.perf_counter()
+            with ThreadPoolExecutor (max_workers = self.concurrency) as executor:
+                for _ in executor.map (lambda index, j=journey: self.__run_journey (j, index),
+                                       indexes):
+                    pass
+            seconds = time.perf_counter() - start
+
+            journeys = self.results[journey]["journeys"]
+            requests = self.results[journey]["requests"]
+            self.results[journey] = {
+                "journeys":            len(journeys),
+                "errors":              self.results[journey]["errors"],
+                "requests":            len(requests),
+                "seconds":             seconds,
+                "throughput":          len(journeys) / seconds if seconds > 0 else None,
+                "requests_per_second": len(requests) / seconds if seconds > 0 else None,
+                "latency":             latency_summary (journeys),
+                "request_latency":     latency_summary (requests)
+            }
+            self.log.info ("%-20s %4d journeys in %.3fs.", journey, len(journeys), seconds)
+
+            if journey == "submit":
+                self.assign_anonymous_names ()
+
+        return self.results
+
+def escape_value_benchmark (repetitions=1000):
+    """
+    Returns the seconds per call of the escape functions in 'rdf' and of
+    rdflib's Literal.n3() for the kinds of values an autosave escapes.
+    """
+    paragraph = "Data that are \"FAIR\" can be found\r\nand reused. " * 16
+    cases     = {
+        "short_string": (rdf.escape_string_value,  "Applicant",                XSD.string),
+        "long_string":  (rdf.escape_string_value,  (paragraph * 24)[:16384],  XSD.string),
+        "boolean":      (rdf.escape_boolean_value, True,                       XSD.boolean),
+        "integer":      (rdf.escape_value,         1700000000,                 XSD.integer)
+    }
+
+    results = {}
+    for name, (escape_function, value, datatype) in cases.items ():
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            escape_function (value)
+        fast_path = (time.perf_counter() - start) / repetitions
+
+        start = time.perf_counter()
+        for _ in range(repetitions):
+            Literal (value, datatype=datatype).n3()
+        literal_n3 = (time.perf_counter() - start) / repetitions
+
+        results[name] = { "escape_value": fast_path,
+                          "literal_n3":   literal_n3,
+                          "speedup":      literal_n3 / fast_path }
+
+    return results
+
+def git_commit ():
+    """Returns the commit of the source tree, or None outside of a git checkout."""
+    try:
+        output = subprocess.run (["git", "rev-parse", "HEAD"],
+                                 cwd            = os.path.dirname (os.path.abspath (__file__)),
+                                 capture_output = True,
+                                 check          = True,
+                                 timeout        = 5)
+        return output.stdout.decode("utf-8").strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def setup_server (store, storage, latency=0.0):
+    """
+    Returns a WebUserInterfaceServer on STORE, which is 'memory' or
+    'standin', with its files under STORAGE, and the stand-in endpoint or
+    None.
+    """
+    server = wsgi.WebUserInterfaceServer ()
+    server.automatic_login_email = REVIEWER_EMAIL
+    server.identity_provider     = "automatic-login"
+
+    db = server.db
+    db.state_graph            = "https://fair-data-fund.invalid/benchmark"
+    db.cache.storage          = os.path.join (storage, "cache")
+    db.enable_query_audit_log = False
+    db.cache.cache_is_ready ()
+
+    standin = None
+    if store == "standin":
+        standin = sparql_standin.StandinSparqlServer (port=0)
+        standin.latency = latency
+        standin.start ()
+        db.endpoint = standin.url
+    else:
+        db.endpoint = "memory://"
+
+    db.setup_sparql_endpoint ()
+    # Set after the store, so that the in-memory store takes no snapshots.
+    db.storage = storage
+    db.initialize_database ()
+    db.reload_reference_data ()
+    account_uuid = db.insert_account (email      = REVIEWER_EMAIL,
+                                      first_name = "Benchmark",
+                                      last_name  = "Reviewer")
+    server.ranking_reviewers = [account_uuid]
+    return server, standin
+
+def main ():
+    """The entry point to run the benchmark from the command line."""
+
+    logging.basicConfig(format='[%(levelname)s] %(asctime)s - %(name)s: %(message)s',
+                        level=logging.WARNING)
+    add_logging_level ("ACCESS", logging.INFO + 5)
+    add_logging_level ("STORE", logging.INFO + 4)
+    logger = logging.getLogger (__name__)
+
+    parser = argparse.ArgumentParser(
+        prog        = 'python -m fair_data_fund.benchmark',
+        description = 'Replay applicant and reviewer journeys and report their latency.')
+
+    parser.add_argument('--store',          choices=["memory", "standin"], default="memory",
+                        help='Use the in-memory RDF store or the stand-in SPARQL endpoint.')
+    parser.add_argument('--transport',      choices=["test-client", "socket"], default="test-client",
+                        help='Call the WSGI application directly, or over a local socket.')
+    parser.add_argument('--latency',        type=float, default=0.0,
+                        help='Seconds the stand-in SPARQL endpoint waits before answering.')
+    parser.add_argument('--iterations',     type=int,   default=20,
+                        help='Number of journeys of each type.')
+    parser.add_argument('--concurrency',    type=int,   default=1,
+                        help='Number of clients replaying journeys at the same time.')
+    parser.add_argument('--autosave-burst', type=int,   default=10,
+                        help='Number of autosaves per application.')
+    parser.add_argument('--label',          type=str,   default=None,
+                        help='A name for this run, stored in the results.')
+    parser.add_argument('--output',         type=str,   default=None,
+                        help='Write the results as JSON to this file instead of stdout.')
+    parser.add_argument('--verbose',        action='store_true')
+    arguments = parser.parse_args()
+
+    if arguments.verbose:
+        logger.setLevel (logging.INFO)
+
+    storage = tempfile.mkdtemp (prefix="fair-data-fund-benchmark-")
+    standin = None
+    transport = None
+    try:
+        server, standin = setup_server (arguments.store, storage, arguments.latency)
+        if server.db.sparql is None and standin is None:
+            logger.error ("Setting up the RDF store failed.")
+            return 1
+
+        if arguments.transport == "socket":
+            transport = SocketTransport (server)
+        else:
+            transport = TestClientTransport (server)
+        transport.start ()
+
+        benchmark = Benchmark (server, transport,
+                               iterations     = arguments.iterations,
+                               concurrency    = arguments.concurrency,
+                               autosave_burst = arguments.autosave_burst)
+        if not benchmark.prepare ():
+            return 1
+
+        server.db.metrics.reset ()
+        started_at = datetime.now (timezone.utc).strftime ('%Y-%m-%dT%H:%M:%SZ')
+        journeys   = benchmark.run ()
+        queries    = { template: { **{ key: statistics[key] for key in ("calls", "failures", "rows") },
+                                   "seconds": statistics["latency"]["sum"] }
+                       for template, statistics in server.db.metrics.snapshot ().items () }
+        results = {
+            "label":          arguments.label,
+            "commit":         git_commit (),
+            "started_at":     started_at,
+            "python":         platform.python_version (),
+            "store":          arguments.store,
+            "transport":      transport.name,
+            "latency":        arguments.latency,
+            "iterations":     arguments.iterations,
+            "concurrency":    arguments.concurrency,
+            "autosave_burst": arguments.autosave_burst,
+            "journeys":       journeys,
+            "queries":        queries,
+            "microbenchmarks": { "escape_value": escape_value_benchmark () }
+        }
+    finally:
+        if transport is not None:
+            transport.stop ()
+        if standin is not None:
+            standin.stop ()
+        shutil.rmtree (storage, ignore_errors=True)
+
+    output = json.dumps (results, indent=2)
+    if arguments.output is None:
+        print (output)
+    else:
+        with open (arguments.output, "w", encoding="utf-8") as output_file:
+            output_file.write (output + "\n")
+
+    return 1 if any (journey["errors"] for journey in journeys.values ()) else 0
+
+if __name__ == "__main__":
+    sys.exit (main ())
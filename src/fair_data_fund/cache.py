@@ -10,6 +10,9 @@ import os
 import logging
 import hashlib
 import json
+import threading
+import time
+from collections import OrderedDict
 
 class CacheLayer:
     """This class provides the caching layer."""
@@ -17,6 +20,9 @@ class CacheLayer:
     def __init__ (self, storage_path):
         self.storage     = storage_path
         self.log         = logging.getLogger(__name__)
+        self.generations = {}
+        self.counter     = 0
+        self.lock        = threading.Lock()
 
     def make_key (self, input_string):
         """Procedure to turn 'input_string' into a short, unique identifier."""
@@ -57,25 +63,54 @@ class CacheLayer:
 
         return data
 
-    def cache_value (self, prefix, key, value, query=None):
-        """Procedure to store 'value' as a cache."""
-        try:
-            cache_filename = f"{self.storage}/{prefix}_{key}"
-            cache_fd = os.open (cache_filename, os.O_WRONLY | os.O_CREAT, 0o600)
-            with open(cache_fd, "w", encoding = "utf-8") as cache_file:
-                cache_file.write(json.dumps(value))
-                if os.name != 'nt':
-                    os.fchmod (cache_fd, 0o400)
-
-            if query is not None:
-                query_filename = f"{self.storage}/{prefix}_{key}.sparql"
-                query_fd = os.open (query_filename, os.O_WRONLY | os.O_CREAT, 0o600)
-                with open(query_fd, "w", encoding = "utf-8") as query_file:
-                    query_file.write(query)
+    def __generation (self, prefix):
+        """Returns the generation of 'prefix'.  The caller holds 'self.lock'."""
+        parts  = prefix.split ("_")
+        latest = self.generations.get (None, 0)
+        for index in range (1, len(parts) + 1):
+            latest = max (latest, self.generations.get ("_".join (parts[:index]), 0))
+
+        return latest
+
+    def generation (self, prefix):
+        """
+        Returns the number of the last invalidation that covers 'prefix'.
+        Prefixes are nested by underscores, so invalidating 'applications'
+        covers 'applications_list' as well.
+        """
+        with self.lock:
+            return self.__generation (prefix)
+
+    def cache_value (self, prefix, key, value, query=None, generation=None):
+        """
+        Procedure to store 'value' as a cache.  When 'generation' is given and
+        'prefix' has been invalidated since, 'value' may be stale and is not
+        stored.
+        """
+        # The check and the write happen under the lock that invalidations
+        # hold while they delete, so a stale write cannot slip in between.
+        with self.lock:
+            if generation is not None and self.__generation (prefix) != generation:
+                self.log.debug ("Not caching %s, which was invalidated meanwhile.", key)
+                return value
+
+            try:
+                cache_filename = f"{self.storage}/{prefix}_{key}"
+                cache_fd = os.open (cache_filename, os.O_WRONLY | os.O_CREAT, 0o600)
+                with open(cache_fd, "w", encoding = "utf-8") as cache_file:
+                    cache_file.write(json.dumps(value))
                     if os.name != 'nt':
-                        os.fchmod (query_fd, 0o400)
-        except OSError:
-            self.log.error ("Failed to save cache for %s.", key)
+                        os.fchmod (cache_fd, 0o400)
+
+                if query is not None:
+                    query_filename = f"{self.storage}/{prefix}_{key}.sparql"
+                    query_fd = os.open (query_filename, os.O_WRONLY | os.O_CREAT, 0o600)
+                    with open(query_fd, "w", encoding = "utf-8") as query_file:
+                        query_file.write(query)
+                        if os.name != 'nt':
+                            os.fchmod (query_fd, 0o400)
+            except OSError:
+                self.log.error ("Failed to save cache for %s.", key)
 
         return value
 
@@ -91,11 +126,15 @@ class CacheLayer:
 
     def invalidate_by_prefix (self, prefix):
         """Procedure to remove all cache items belonging to 'prefix'."""
-        for file_path in glob.glob(f"{self.storage}/{prefix}_*"):
-            try:
-                os.remove(file_path)
-            except FileNotFoundError:
-                self.log.error ("Trying to remove %s multiple times.", file_path)
+        with self.lock:
+            self.counter += 1
+            self.generations[prefix] = self.counter
+
+            for file_path in glob.glob(f"{self.storage}/{prefix}_*"):
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    self.log.error ("Trying to remove %s multiple times.", file_path)
 
         return True
 
@@ -108,14 +147,78 @@ class CacheLayer:
         if self.storage in ("", "/"):
             return False
 
-        files = glob.glob(f"{self.storage}/*")
-        self.log.info ("Removing %d files.", len(files))
-        for file_path in files:
+        with self.lock:
+            self.counter += 1
+            self.generations[None] = self.counter
+
+            files = glob.glob(f"{self.storage}/*")
+            self.log.info ("Removing %d files.", len(files))
+            for file_path in files:
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    self.log.error ("Trying to remove %s multiple times.", file_path)
+                except IsADirectoryError:
+                    pass
+
+        return True
+
+
+class MemoryCacheLayer:
+    """
+    This class provides a bounded, thread-safe in-memory cache.  Items expire
+    after 'ttl' seconds, and the least recently used item is evicted when more
+    than 'maximum_size' items are stored.
+    """
+
+    def __init__ (self, maximum_size=1024, ttl=300):
+        self.maximum_size = maximum_size
+        self.ttl          = ttl
+        self.items        = OrderedDict()
+        self.lock         = threading.Lock()
+        self.log          = logging.getLogger(__name__)
+
+    def cached_value (self, key):
+        """Returns the cached value or None."""
+        if key is None:
+            return None
+
+        with self.lock:
             try:
-                os.remove(file_path)
-            except FileNotFoundError:
-                self.log.error ("Trying to remove %s multiple times.", file_path)
-            except IsADirectoryError:
-                pass
+                expires_at, value = self.items[key]
+            except KeyError:
+                return None
+
+            if expires_at < time.monotonic():
+                del self.items[key]
+                return None
+
+            self.items.move_to_end (key)
+            return value
+
+    def cache_value (self, key, value):
+        """Procedure to store 'value' under 'key'."""
+        if key is None or self.maximum_size < 1:
+            return value
+
+        with self.lock:
+            self.items[key] = (time.monotonic() + self.ttl, value)
+            self.items.move_to_end (key)
+            while len(self.items) > self.maximum_size:
+                self.items.popitem (last=False)
+
+        return value
+
+    def remove_cached_value (self, key):
+        """Procedure to invalidate the cache item identified by 'key'."""
+        with self.lock:
+            self.items.pop (key, None)
+
+        return True
+
+    def invalidate_all (self):
+        """Procedure to remove all cache items."""
+        with self.lock:
+            self.items.clear()
 
         return True
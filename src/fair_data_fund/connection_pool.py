@@ -0,0 +1,238 @@
+"""
+This module provides a SPARQL store that keeps HTTP connections to the
+SPARQL endpoint alive between queries, so that the TCP (and TLS) set-up
+cost is paid once per connection instead of once per query.  Read queries
+can be spread over several replicas of the SPARQL endpoint.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from io import BytesIO
+from urllib.error import URLError, HTTPError
+from urllib.parse import urlencode
+import urllib3
+from rdflib import BNode
+from rdflib.query import Result
+from rdflib.plugins.stores import sparqlstore
+from fair_data_fund import rdf
+
+class ReadEndpointBalancer:
+    """
+    This class hands out read endpoints in round-robin order.  Endpoints
+    that failed are skipped until 'cool_down' seconds have passed.  The
+    'fallback' endpoint, usually the primary, is tried last.
+
+    Replicas may lag behind the primary, so for 'replica_lag' seconds
+    after a write, and for reads that must see the latest state, only the
+    fallback is handed out.
+    """
+
+    def __init__ (self, endpoints, fallback, cool_down=30.0, replica_lag=5.0):
+        self.endpoints  = list(endpoints)
+        self.fallback   = fallback
+        self.cool_down  = cool_down
+        self.replica_lag = replica_lag
+        self.primary_until = 0
+        self.down_until = {}
+        self.position   = 0
+        self.lock       = threading.Lock()
+        self.local      = threading.local()
+        self.log        = logging.getLogger(__name__)
+
+    def record_write (self):
+        """Procedure to send reads to the fallback until replicas have caught up."""
+        with self.lock:
+            self.primary_until = time.monotonic() + self.replica_lag
+
+    @contextmanager
+    def primary_reads (self):
+        """Context manager that sends the reads of the calling thread to the fallback."""
+        previous = getattr (self.local, "primary", False)
+        self.local.primary = True
+        try:
+            yield
+        finally:
+            self.local.primary = previous
+
+    def candidates (self, primary=False):
+        """
+        Returns the endpoints to try for the next read query, in order, or
+        only the fallback when PRIMARY is True.
+        """
+        now = time.monotonic()
+        if (primary or getattr (self.local, "primary", False) or
+            now < self.primary_until):
+            return [self.fallback]
+
+        with self.lock:
+            start = self.position
+            self.position = (self.position + 1) % max(len(self.endpoints), 1)
+            rotated = self.endpoints[start:] + self.endpoints[:start]
+            healthy = [endpoint for endpoint in rotated
+                       if self.down_until.get (endpoint, 0) <= now]
+
+        if self.fallback not in healthy:
+            healthy.append (self.fallback)
+        return healthy
+
+    def mark_down (self, endpoint):
+        """Procedure to skip ENDPOINT for the next 'cool_down' seconds."""
+        if endpoint == self.fallback:
+            return None
+
+        with self.lock:
+            was_up = self.down_until.get (endpoint, 0) <= time.monotonic()
+            self.down_until[endpoint] = time.monotonic() + self.cool_down
+
+        if was_up:
+            self.log.warning ("Read endpoint %s seems down; skipping it for %s seconds.",
+                              endpoint, self.cool_down)
+        return None
+
+    def mark_up (self, endpoint):
+        """Procedure to record that ENDPOINT answered."""
+        with self.lock:
+            was_down = self.down_until.pop (endpoint, None) is not None
+
+        if was_down:
+            self.log.info ("Read endpoint %s is back.", endpoint)
+
+class PooledSPARQLUpdateStore (sparqlstore.SPARQLUpdateStore):
+    """
+    This class implements rdflib's SPARQLUpdateStore on top of a pool of
+    persistent HTTP connections shared by all threads.
+
+    Errors are reported the same way urllib reports them: HTTPError for
+    error responses and URLError for connection failures.  Requests that
+    run past the deadline set by the calling thread raise TimeoutError.
+    """
+
+    def __init__ (self, pool_size=10, read_balancer=None, **kwargs):
+        super().__init__(**kwargs)
+        self.pool_size  = pool_size
+        self.read_balancer = read_balancer
+        self.pool       = urllib3.PoolManager (maxsize  = pool_size,
+                                               block    = False,
+                                               retries  = False)
+        self.accept_header = self.response_mime_types ()
+        self.deadlines  = threading.local()
+
+    def set_deadline (self, deadline):
+        """
+        Procedure to abort the requests of the calling thread at DEADLINE,
+        a time.monotonic() value, or never when DEADLINE is None.
+        """
+        self.deadlines.value = deadline
+
+    def __timeout (self):
+        """Returns the urllib3 timeout for the next request of the calling thread."""
+        deadline = getattr (self.deadlines, "value", None)
+        if deadline is None:
+            return None
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError ("The deadline of the SPARQL request has passed.")
+
+        return urllib3.Timeout (total = remaining)
+
+    def __post (self, url, body, content_type, parameters=None, preload_content=True):
+        """Returns the response for POSTing BODY to URL."""
+
+        if parameters:
+            url = f"{url}?{urlencode(parameters)}"
+
+        headers = {
+            "Accept":       self.accept_header,
+            "Content-Type": content_type
+        }
+        try:
+            response = self.pool.request ("POST", url,
+                                          body    = body.encode("utf-8"),
+                                          headers = headers,
+                                          timeout = self.__timeout (),
+                                          preload_content = preload_content)
+        except urllib3.exceptions.NewConnectionError as error:
+            # Refused connections are reported as a kind of timeout by urllib3.
+            raise URLError (error) from error
+        except urllib3.exceptions.TimeoutError as error:
+            raise TimeoutError (error) from error
+        except urllib3.exceptions.HTTPError as error:
+            raise URLError (error) from error
+
+        if response.status >= 400:
+            if not preload_content:
+                response.drain_conn ()
+                response.release_conn ()
+            raise HTTPError (url, response.status, response.reason,
+                             response.headers, None)
+
+        return response
+
+    def __post_query (self, query, parameters=None, preload_content=True):
+        """
+        Returns the response for QUERY from the first read endpoint that
+        answers.  Updates never take this path; they go to the primary.
+        """
+        if self.read_balancer is None:
+            return self.__post (self.query_endpoint, query, "application/sparql-query",
+                                parameters, preload_content)
+
+        candidates = self.read_balancer.candidates ()
+        for index, endpoint in enumerate (candidates):
+            try:
+                response = self.__post (endpoint, query, "application/sparql-query",
+                                        parameters, preload_content)
+            except URLError as error:
+                # Client errors would fail on any replica.
+                if isinstance (error, HTTPError) and error.code < 500:
+                    raise
+                self.read_balancer.mark_down (endpoint)
+                if index == len(candidates) - 1:
+                    raise
+                continue
+
+            self.read_balancer.mark_up (endpoint)
+            return response
+
+        return None
+
+    def _query (self, query, default_graph=None, named_graph=None):  # pylint: disable=arguments-differ
+        self._queries += 1
+
+        parameters = {}
+        # Calls to Graph.query() pass a useless BNode default graph.
+        if default_graph is not None and not isinstance (default_graph, BNode):
+            parameters["default-graph-uri"] = default_graph
+
+        response = self.__post_query (query, parameters)
+        content_type = response.headers.get ("Content-Type", "").split(";")[0]
+        return Result.parse (BytesIO (response.data), content_type=content_type)
+
+    def query_bindings (self, query):
+        """Yields the bindings of QUERY while its response is being read."""
+        self._queries += 1
+
+        response = self.__post_query (query, preload_content = False)
+        try:
+            yield from rdf.iterate_json_bindings (response)
+        except urllib3.exceptions.TimeoutError as error:
+            raise TimeoutError (error) from error
+        finally:
+            response.drain_conn ()
+            response.release_conn ()
+
+    def _update (self, update):
+        self._updates += 1
+        self.__post (self.update_endpoint, update,
+                     "application/sparql-update; charset=UTF-8")
+        if self.read_balancer is not None:
+            self.read_balancer.record_write ()
+
+    def close (self, commit_pending_transaction=False):
+        """Procedure to close all pooled connections."""
+        if commit_pending_transaction:
+            self.commit ()
+        self.pool.clear ()
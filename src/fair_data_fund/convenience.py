@@ -5,6 +5,7 @@ the codebase.
 
 import logging
 from datetime import datetime
+from functools import lru_cache
 
 def value_or (record, key, other):
     """Return the value of KEY or OTHER."""
@@ -26,6 +27,7 @@ def index_exists (value, index):
 
     return True
 
+@lru_cache(maxsize=4096)
 def epoch_to_human_readable (epoch):
     """Returns a human-readable string for EPOCH."""
     return datetime.utcfromtimestamp(epoch).strftime('%Y-%m-%dT%H:%M:%SZ')
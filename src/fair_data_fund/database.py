@@ -3,14 +3,36 @@
 import secrets
 import os
 import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
 from datetime import datetime
+from types import MappingProxyType
 from urllib.error import URLError, HTTPError
 from rdflib import Dataset, Graph, Literal, RDF, RDFS, XSD, URIRef
 from rdflib.plugins.stores import sparqlstore
-from rdflib.store import CORRUPTED_STORE, NO_STORE
-from jinja2 import Environment, FileSystemLoader
-from fair_data_fund import cache, rdf
-from fair_data_fund.convenience import epoch_to_human_readable
+from rdflib.store import CORRUPTED_STORE, NO_STORE, VALID_STORE
+from jinja2 import Environment, FileSystemLoader, TemplateError
+from fair_data_fund import cache, connection_pool, journal, local_store, metrics, rdf
+from fair_data_fund import validator, write_behind
+from fair_data_fund.convenience import epoch_to_human_readable, value_or_none
+
+## The fields of an application, by their type in the state graph.
+APPLICATION_STRING_FIELDS  = ("name", "pronouns", "email", "institution",
+                              "faculty", "department", "position", "discipline",
+                              "datatype", "description", "size", "whodoesit",
+                              "achievement", "fair_summary", "findable",
+                              "accessible", "interoperable", "reusable",
+                              "summary", "promotion", "linked_publication",
+                              "data_timing", "refinement", "budget_filename")
+APPLICATION_BOOLEAN_FIELDS = ("interview_consent", "checkpoints_consent",
+                              "financial_consent", "organization_consent")
+
+## The fields written by update_application.  The budget filename is only
+## written by update_application_budget_upload.
+APPLICATION_FORM_FIELDS = tuple(field for field in APPLICATION_STRING_FIELDS
+                                if field != "budget_filename") + APPLICATION_BOOLEAN_FIELDS
 
 class SparqlInterface:
     """This class reads and writes data from a SPARQL endpoint."""
@@ -19,20 +41,68 @@ class SparqlInterface:
 
         self.endpoint     = "http://127.0.0.1:8890/sparql"
         self.update_endpoint = None
+        self.read_endpoints = []
+        self.read_endpoint_cool_down = 30.0
+        self.replica_lag = 5.0
+        self.read_balancer = None
+        self.connection_pool_size = 10
         self.state_graph  = "default://graph"
         self.log          = logging.getLogger(__name__)
         self.cache        = cache.CacheLayer(None)
+        self.session_cache = cache.MemoryCacheLayer()
 
         sparql_templates_path = os.path.join(os.path.dirname(__file__),
                                              "resources",
                                              "sparql_templates")
+        # Values are escaped for SPARQL by the 'rdf' module, so HTML
+        # autoescaping would only add work.
         self.jinja        = Environment(loader = FileSystemLoader(sparql_templates_path),
-                                        autoescape = True)
+                                        autoescape = False)
+        self.sparql_templates = {}
+        for filename in self.jinja.list_templates (extensions = ["sparql"]):
+            name = filename[:-len(".sparql")]
+            self.sparql_templates[name] = self.jinja.get_template (filename)
+
+        # The type of a query only depends on its template, so it is looked
+        # up by template name instead of scanning every rendered query.
+        # The queries that are built in code have a fixed type too.
+        self.query_types  = {
+            "insert_data":                ("update", "INSERT"),
+            "state_graph_is_initialized": ("gather", "ASK")
+        }
+        for name, template in self.sparql_templates.items ():
+            try:
+                execution_type, query_type = rdf.query_type (template.render ())
+            except TemplateError:
+                continue
+            if execution_type is not None:
+                self.query_types[name] = (execution_type, query_type)
+        self.rendered_queries = {}
         self.storage      = None
         self.sparql       = None
         self.sparql_is_up = False
         self.enable_query_audit_log = True
+        self.transactions_directory = None
+        self.journal_flush_interval = 1.0
+        self.journal_rotate_size = 16777216
+        self.journal      = None
         self.store        = None
+        self.local_store  = None
+        self.bdb_cache_size = 52428800
+        self.bdb_commit_interval = 0.2
+        self.snapshot_interval = 60.0
+        self.write_behind_interval = 0
+        self.insert_batch_size = 262144
+        self.insert_parallelism = 1
+        self.write_behind = None
+        self.query_retries = 5
+        self.retry_delay  = 0.1
+        self.maximum_retry_delay = 10.0
+        self.query_timeout = 0
+        self.institutions_snapshot = None
+        self.metrics      = metrics.QueryMetrics()
+        self.slow_query_threshold = 0
+        self.slow_query_log = logging.getLogger(f"{__name__}.slow_queries")
 
     # SPARQL INTERACTION BITS
     # -------------------------------------------------------------------------
@@ -43,130 +113,359 @@ class SparqlInterface:
         # BerkeleyDB as local RDF store.
         if (isinstance (self.endpoint, str) and self.endpoint.startswith("bdb://")):
             directory = self.endpoint[6:]
-            self.sparql = Dataset("BerkeleyDB")
-            self.sparql.open (directory, create=True)
-            if not isinstance (self.sparql, Dataset):
-                if self.sparql == CORRUPTED_STORE:
+            if not local_store.BERKELEYDB_DEPENDENCY_LOADED:
+                self.log.error ("Using a BerkeleyDB store requires the 'berkeleydb' package.")
+                return None
+
+            store  = local_store.BerkeleyDBStore (cache_size      = self.bdb_cache_size,
+                                                  commit_interval = self.bdb_commit_interval)
+            self.sparql = Dataset(store = store)
+            status = self.sparql.open (directory, create=True)
+            if status != VALID_STORE:
+                if status == CORRUPTED_STORE:
                     self.log.error ("'%s' is corrupted.", directory)
-                elif self.sparql == NO_STORE:
+                elif status == NO_STORE:
                     self.log.error ("'%s' is not a BerkeleyDB store.", directory)
                 else:
-                    self.log.error ("Loading '%s' returned %s.", directory, self.sparql)
+                    self.log.error ("Loading '%s' returned %s.", directory, status)
+                self.sparql = None
                 return None
+            self.local_store = store
             self.log.info ("Using BerkeleyDB RDF store.")
 
+        # rdflib's in-memory store, with snapshots under the storage root.
+        elif (isinstance (self.endpoint, str) and self.endpoint.startswith("memory://")):
+            filename      = self.endpoint[9:] or "rdf-store.nq"
+            snapshot_path = None
+            if self.storage is not None:
+                snapshot_path = os.path.join (self.storage, filename)
+            else:
+                self.log.warning ("Without a storage root, the in-memory RDF store "
+                                  "is lost on exit.")
+
+            store = local_store.MemoryStore (snapshot_path, self.snapshot_interval)
+            if not store.load ():
+                return None
+            store.start ()
+            self.sparql      = store.dataset
+            self.local_store = store
+            self.log.info ("Using in-memory RDF store.")
+
         # External SPARQL endpoints, like Virtuoso.
         else:
             if self.update_endpoint is None:
                 self.update_endpoint = self.endpoint
 
-            self.store = sparqlstore.SPARQLUpdateStore(
+            store_arguments = {
                 # Avoid rdflib from wrapping in a blank-node graph by setting
                 # context_aware to False.
-                context_aware   = False,
-                query_endpoint  = self.endpoint,
-                update_endpoint = self.update_endpoint,
-                returnFormat    = "json",
-                method          = "POST")
+                "context_aware":   False,
+                "query_endpoint":  self.endpoint,
+                "update_endpoint": self.update_endpoint,
+                "returnFormat":    "json",
+                "method":          "POST"
+            }
+            # Gather queries are spread over the read endpoints, while
+            # updates only go to the primary.
+            if self.read_endpoints:
+                self.read_balancer = connection_pool.ReadEndpointBalancer (
+                    self.read_endpoints, self.endpoint, self.read_endpoint_cool_down,
+                    self.replica_lag)
+
+            if self.connection_pool_size > 0:
+                self.store = connection_pool.PooledSPARQLUpdateStore(
+                    pool_size     = self.connection_pool_size,
+                    read_balancer = self.read_balancer,
+                    **store_arguments)
+            else:
+                if self.read_balancer is not None:
+                    self.log.warning ("Read endpoints require a connection pool.")
+                    self.log.warning ("Sending all queries to %s.", self.endpoint)
+                    self.read_balancer = None
+                self.store = sparqlstore.SPARQLUpdateStore(**store_arguments)
             # Set bind_namespaces so rdflib does not inject PREFIXes.
             self.sparql  = Graph(store = self.store, bind_namespaces = "none")
             self.log.info ("Using external RDF store.")
 
+        if self.enable_query_audit_log and self.transactions_directory is not None:
+            self.journal = journal.QueryJournal (self.transactions_directory,
+                                                 self.journal_flush_interval,
+                                                 self.journal_rotate_size)
+            if self.journal.start():
+                self.log.info ("Writing the query audit log to '%s'.",
+                               self.transactions_directory)
+            else:
+                self.journal = None
+
+        if self.write_behind_interval > 0:
+            self.write_behind = write_behind.WriteBehindQueue (
+                self.__write_application_update,
+                self.write_behind_interval)
+            self.write_behind.start()
+
         self.sparql_is_up = True
         return None
 
     def __log_query (self, query, prefix="Query"):
         self.log.info ("%s:\n---\n%s\n---", prefix, query)
 
-    def __query_from_template (self, name, args=None):
-        template   = self.jinja.get_template (f"{name}.sparql")
+    def audit_query (self, query):
+        """Procedure to record the update QUERY in the query audit log."""
+        if not self.enable_query_audit_log:
+            return None
+
+        if self.journal is not None:
+            self.journal.append (query)
+        else:
+            self.__log_query (query, "Query Audit Log")
+
+        return None
+
+    def query_from_template (self, name, args=None):
+        """Returns the query for the SPARQL template NAME rendered with ARGS."""
+        template   = self.sparql_templates[name]
         parameters = { "state_graph": self.state_graph }
+
+        # Queries without arguments only depend on the state graph,
+        # so they only have to be rendered once.
         if args is None:
-            args = {}
-
-        return template.render ({ **args, **parameters })
-
-    def __normalize_binding (self, row):
-        output = {}
-        for name in row.keys():
-            if isinstance(row[name], Literal):
-                xsd_type = row[name].datatype
-                if xsd_type == XSD.integer:
-                    if str(name).endswith("_date"):
-                        output[str(name)] = epoch_to_human_readable (int(row[name]))
-                    else:
-                        output[str(name)] = int(float(row[name]))
-                elif xsd_type == XSD.decimal:
-                    output[str(name)] = int(float(row[name]))
-                elif xsd_type == XSD.boolean:
-                    try:
-                        output[str(name)] = bool(int(row[name]))
-                    except ValueError:
-                        output[str(name)] = str(row[name]).lower() == "true"
-                elif xsd_type == XSD.dateTime:
-                    self.log.warning ("Using xsd:dateTime is deprecated.")
-                    time_value = row[name].partition(".")[0]
-                    if time_value[-1] == 'Z':
-                        time_value = time_value[:-1]
-                    if time_value.endswith("+00:00"):
-                        time_value = time_value[:-6]
-                    output[str(name)] = time_value
-                elif xsd_type == XSD.date:
-                    output[str(name)] = row[name]
-                elif xsd_type == XSD.string:
-                    if row[name] == "NULL":
-                        output[str(name)] = None
-                    else:
-                        output[str(name)] = str(row[name])
-                # bindings that were produced with BIND() on Virtuoso
-                # have no XSD type.
-                elif xsd_type is None:
-                    output[str(name)] = str(row[name])
-            elif row[name] is None:
-                output[str(name)] = None
-            else:
-                output[str(name)] = str(row[name])
+            key = (name, self.state_graph)
+            try:
+                return self.rendered_queries[key]
+            except KeyError:
+                started = time.monotonic()
+                query = template.render (parameters)
+                self.metrics.record_render (name, time.monotonic() - started)
+                self.rendered_queries[key] = query
+                return query
+
+        started = time.monotonic()
+        query   = template.render ({ **args, **parameters })
+        self.metrics.record_render (name, time.monotonic() - started)
+        return query
+
+    def __column_converter (self, name, value):
+        """
+        Returns a procedure that normalizes VALUE, and any other value of the
+        column NAME with the same type, or None when the column is omitted.
+        """
+        if not isinstance (value, Literal):
+            return str
+
+        xsd_type = value.datatype
+        if xsd_type == XSD.integer:
+            if name.endswith("_date"):
+                return lambda value: epoch_to_human_readable (int(value))
+            return lambda value: int(float(value))
+        if xsd_type == XSD.decimal:
+            return lambda value: int(float(value))
+        if xsd_type == XSD.boolean:
+            return self.__normalize_boolean
+        if xsd_type == XSD.dateTime:
+            return self.__normalize_datetime
+        if xsd_type == XSD.date:
+            return lambda value: value
+        if xsd_type == XSD.string:
+            return lambda value: None if value == "NULL" else str(value)
+        # bindings that were produced with BIND() on Virtuoso
+        # have no XSD type.
+        if xsd_type is None:
+            return str
+
+        return None
+
+    def __normalize_boolean (self, value):
+        try:
+            return bool(int(value))
+        except ValueError:
+            return str(value).lower() == "true"
+
+    def __normalize_datetime (self, value):
+        self.log.warning ("Using xsd:dateTime is deprecated.")
+        time_value = value.partition(".")[0]
+        if time_value[-1] == 'Z':
+            time_value = time_value[:-1]
+        if time_value.endswith("+00:00"):
+            time_value = time_value[:-6]
+        return time_value
+
+    def row_normalizer (self):
+        """
+        Returns a procedure to normalize the rows of a single query result.
+        The converter for each column is determined once, from the first
+        value in that column, and is only re-determined when a value of
+        another type shows up in the same column.
+        """
+        columns = {}
+
+        def normalize (row):
+            output = {}
+            for variable, value in row.items():
+                if value is None:
+                    output[str(variable)] = None
+                    continue
+
+                datatype = getattr (value, "datatype", None)
+                column   = columns.get (variable)
+                if column is None or column[0] != datatype:
+                    name   = str(variable)
+                    column = (datatype, name, self.__column_converter (name, value))
+                    columns[variable] = column
+
+                if column[2] is not None:
+                    output[column[1]] = column[2] (value)
+
+            return output
+
+        return normalize
+
+    def query_deadline (self):
+        """Returns the time.monotonic() value at which a new query must be aborted, or None."""
+        if self.query_timeout > 0:
+            return time.monotonic() + self.query_timeout
+        return None
+
+    def backoff_delay (self, attempt, deadline=None):
+        """
+        Returns the number of seconds to wait before retrying a query that
+        failed ATTEMPT times already, or None when it should not be retried.
+        """
+        if attempt >= self.query_retries:
+            return None
+
+        # Exponential backoff with "full jitter", so that the workers that
+        # were turned away at the same moment do not all return together.
+        delay = random.uniform (0, min (self.maximum_retry_delay,
+                                        self.retry_delay * (2 ** attempt)))
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
 
-        return output
+        return delay
+
+    def __store_lock (self, execution_type):
+        """
+        Returns a context manager that guards EXECUTION_TYPE queries against
+        concurrent updates to the in-process store.
+        """
+        if self.local_store is None:
+            return nullcontext ()
+        if execution_type == "update":
+            return self.local_store.writing ()
+        return self.local_store.reading ()
+
+    def __prepared_query (self, query, execution_type):
+        """Returns QUERY in the form to pass to the in-process store."""
+        if self.local_store is None:
+            return query
+        return local_store.prepared_query (query, execution_type)
+
+    def primary_reads (self, primary=True):
+        """
+        Returns a context manager that sends the read queries of the calling
+        thread to the primary endpoint when PRIMARY is True, for reads that
+        must see the latest writes.
+        """
+        if not primary or self.read_balancer is None:
+            return nullcontext ()
+        return self.read_balancer.primary_reads ()
 
-    def __run_query (self, query, cache_key_string=None, prefix=None, retries=5):
+    def __set_deadline (self, deadline):
+        """Procedure to bound the HTTP requests of the calling thread by DEADLINE."""
+        if isinstance (self.store, connection_pool.PooledSPARQLUpdateStore):
+            self.store.set_deadline (deadline)
 
-        cache_key = None
+    def record_query_metrics (self, query, template, started, rows=None, failed=False):
+        """
+        Procedure to record the metrics of QUERY from TEMPLATE, which was
+        sent at the monotonic time STARTED, and to log it when it was slow.
+        """
+        seconds = time.monotonic() - started
+        is_slow = 0 < self.slow_query_threshold <= seconds
+        self.metrics.record_query (template, seconds, rows, failed, is_slow)
+        if is_slow:
+            self.slow_query_log.warning ("Query from template '%s' took %.3f seconds:\n---\n%s\n---",
+                                         template or self.metrics.UNKNOWN_TEMPLATE,
+                                         seconds, query)
+
+    def __run_query (self, query, cache_key_string=None, prefix=None, template=None,
+                     primary=False):
+        """
+        Returns the normalized results for QUERY, True for successful updates,
+        or [] on failure.  TEMPLATE is the name under which the metrics of
+        the query are recorded.  With PRIMARY, a read query is not sent to a
+        read replica, which may not have caught up with the latest writes.
+        """
+
+        cache_key  = None
+        generation = None
         if cache_key_string is not None:
             cache_key = self.cache.make_key (cache_key_string)
             cached    = self.cache.cached_value(prefix, cache_key)
+            self.metrics.record_cache_lookup (template, cached is not None)
             if cached is not None:
                 return cached
+            # An invalidation while the query runs makes its results stale.
+            generation = self.cache.generation (prefix)
+
+        started = time.monotonic()
+        with self.primary_reads (primary):
+            results = self.__execute_query (query, cache_key, prefix,
+                                            query_types = self.query_types.get (template),
+                                            generation  = generation)
+        if results is None:
+            self.record_query_metrics (query, template, started, failed=True)
+            return []
+
+        rows = len(results) if isinstance (results, list) else None
+        self.record_query_metrics (query, template, started, rows)
+        return results
+
+    def __execute_query (self, query, cache_key=None, prefix=None, attempt=0, deadline=None,
+                         query_types=None, generation=None):
+        """
+        Returns the normalized results for QUERY, True for updates, or None on
+        failure.  QUERY_TYPES holds the execution type and query type, as
+        returned by rdf.query_type, which is used when it is None.  The
+        results are only cached when PREFIX is still at GENERATION.
+        """
 
-        results = []
+        if attempt == 0:
+            deadline = self.query_deadline ()
+        self.__set_deadline (deadline)
+
+        results = None
         try:
-            execution_type, query_type = rdf.query_type (query)
+            execution_type, query_type = query_types or rdf.query_type (query)
             if execution_type == "update":
-                self.sparql.update (query)
+                prepared = self.__prepared_query (query, execution_type)
+                with self.__store_lock (execution_type):
+                    self.sparql.update (prepared)
                 # Upon failure, an exception is thrown.
-                if self.enable_query_audit_log:
-                    self.__log_query (query, "Query Audit Log")
+                self.audit_query (query)
                 results = True
             elif execution_type == "gather":
-                query_results = self.sparql.query(query)
-                # ASK queries only return a boolean.
-                if query_type == "ASK":
-                    results = query_results.askAnswer
-                elif isinstance(query_results, tuple):
-                    self.log.error ("Error executing query (%s): %s",
-                                    query_results[0], query_results[1])
-                    self.__log_query (query)
-                    return []
-                else:
-                    results = list(map(self.__normalize_binding,
-                                       query_results.bindings))
+                # The results are computed while reading the bindings.
+                prepared = self.__prepared_query (query, execution_type)
+                with self.__store_lock (execution_type):
+                    query_results = self.sparql.query(prepared)
+                    # ASK queries only return a boolean.
+                    if query_type == "ASK":
+                        results = query_results.askAnswer
+                    elif isinstance(query_results, tuple):
+                        self.log.error ("Error executing query (%s): %s",
+                                        query_results[0], query_results[1])
+                        self.__log_query (query)
+                        return None
+                    else:
+                        results = list(map(self.row_normalizer (),
+                                           query_results.bindings))
             else:
                 self.log.error ("Invalid query (%s, %s)", execution_type, query_type)
                 self.__log_query (query)
-                return []
+                return None
 
-            if cache_key_string is not None:
-                self.cache.cache_value (prefix, cache_key, results, query)
+            if cache_key is not None:
+                self.cache.cache_value (prefix, cache_key, results, query, generation)
 
             if not self.sparql_is_up:
                 self.log.info ("Connection to the SPARQL endpoint seems up again.")
@@ -185,22 +484,32 @@ class SparqlInterface:
                     self.log.error ("Endpoint seems to require authentication.")
                     self.sparql_is_up = False
             if error.code == 503:
-                if retries > 0:
-                    self.log.warning ("Retrying SPARQL request due to service unavailability (%s)",
-                                      retries)
-                    return self.__run_query (query, cache_key_string=cache_key_string,
-                                             prefix=prefix, retries=(retries - 1)) # pylint: disable=superfluous-parens
+                delay = self.backoff_delay (attempt, deadline)
+                if delay is not None:
+                    self.log.warning ("Retrying SPARQL request in %.2f seconds due to "
+                                      "service unavailability (%d/%d)",
+                                      delay, attempt + 1, self.query_retries)
+                    time.sleep (delay)
+                    return self.__execute_query (query, cache_key=cache_key,
+                                                 prefix=prefix, attempt=(attempt + 1), # pylint: disable=superfluous-parens
+                                                 deadline=deadline, query_types=query_types,
+                                                 generation=generation)
 
                 self.log.warning ("Giving up on retrying SPARQL request.")
 
             self.log.error ("SPARQL endpoint returned %d:\n---\n%s\n---",
                             error.code, error.reason)
-            return []
+            return None
+        except TimeoutError:
+            self.log.error ("SPARQL query exceeded the deadline of %s seconds.",
+                            self.query_timeout)
+            self.__log_query (query)
+            return None
         except URLError:
             if self.sparql_is_up:
                 self.log.error ("Connection to the SPARQL endpoint seems down.")
                 self.sparql_is_up = False
-                return []
+                return None
         except AttributeError as error:
             self.log.error ("SPARQL query failed.")
             self.log.error ("Exception: %s", error)
@@ -209,46 +518,123 @@ class SparqlInterface:
             self.log.error ("SPARQL query failed.")
             self.log.error ("Exception: %s: %s", type(error), error)
             self.__log_query (query)
-            return []
+            return None
 
         return results
 
-    def __insert_query_for_graph (self, graph):
-        return rdf.insert_query (self.state_graph, graph)
+    def __iterate_query (self, query, template=None):
+        """
+        Yields the normalized rows for the SELECT QUERY one by one.  A failure
+        is logged and raised again, so that it cannot be mistaken for the end
+        of the results.
+        """
+        self.__set_deadline (self.query_deadline ())
+        started = time.monotonic()
+        rows    = 0
+        failed  = False
+        try:
+            if isinstance (self.store, connection_pool.PooledSPARQLUpdateStore):
+                bindings = self.store.query_bindings (query)
+            else:
+                # Reading the bindings computes all results at once, so the
+                # in-process store is not locked while the rows are used.
+                prepared = self.__prepared_query (query, "gather")
+                with self.__store_lock ("gather"):
+                    bindings = self.sparql.query (prepared).bindings
+
+            normalize = self.row_normalizer ()
+            for row in bindings:
+                rows += 1
+                yield normalize (row)
+
+        except (HTTPError, URLError) as error:
+            failed = True
+            self.log.error ("SPARQL endpoint returned an error: %s", error)
+            self.__log_query (query)
+            raise
+        except TimeoutError:
+            failed = True
+            self.log.error ("SPARQL query exceeded the deadline of %s seconds.",
+                            self.query_timeout)
+            self.__log_query (query)
+            raise
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            failed = True
+            self.log.error ("SPARQL query failed.")
+            self.log.error ("Exception: %s: %s", type(error), error)
+            self.__log_query (query)
+            raise
+        finally:
+            self.record_query_metrics (query, template, started, rows, failed)
+
+    def __insert_queries (self, lines):
+        """
+        Yields INSERT DATA queries for the N-Triples LINES, each holding as
+        many triples as fit in 'insert_batch_size' bytes.
+        """
+        batch      = []
+        batch_size = 0
+        for line in lines:
+            line_size = len(line.encode("utf-8"))
+            if batch and batch_size + line_size > self.insert_batch_size:
+                yield rdf.insert_data_query (self.state_graph, "".join(batch))
+                batch      = []
+                batch_size = 0
+            batch.append (line)
+            batch_size += line_size
+
+        if batch:
+            yield rdf.insert_data_query (self.state_graph, "".join(batch))
 
     def add_triples_from_graph (self, graph):
-        """Inserts triples from GRAPH into the state graph."""
-
-        # There's an upper limit to how many triples one can add in a single
-        # INSERT query.  To stay on the safe side, we create batches of 250
-        # triplets per INSERT query.
-
-        counter             = 0
-        processing_complete = True
-        insertable_graph    = Graph()
-
-        for subject, predicate, noun in graph:
-            counter += 1
-            insertable_graph.add ((subject, predicate, noun))
-            if counter >= 250:
-                query = self.__insert_query_for_graph (insertable_graph)
-                if not self.__run_query (query):
-                    processing_complete = False
-                    break
-
-                # Reset the graph by creating a new one.
-                insertable_graph = Graph()
-                counter = 0
-
-        query = self.__insert_query_for_graph (insertable_graph)
-        if not self.__run_query (query):
-            processing_complete = False
-
-        if processing_complete:
+        """
+        Inserts triples from GRAPH, an rdflib Graph or an rdf.TripleBuilder,
+        into the state graph.
+        """
+
+        # There's an upper limit to how large a single INSERT query can be.
+        # Triples are therefore sent in batches bounded by their serialized
+        # size, optionally with several batches in flight at the same time.
+
+        if isinstance (graph, rdf.TripleBuilder):
+            lines = graph.ntriples_lines ()
+        else:
+            lines = (rdf.ntriples_line (*triple) for triple in graph)
+
+        failed_query = None
+        if self.insert_parallelism > 1 and self.local_store is None:
+            with ThreadPoolExecutor (max_workers = self.insert_parallelism) as executor:
+                in_flight = {}
+                for query in self.__insert_queries (lines):
+                    if len(in_flight) >= self.insert_parallelism:
+                        done, _ = wait (in_flight, return_when = FIRST_COMPLETED)
+                        failed_query = next((in_flight[future] for future in done
+                                             if not future.result()), None)
+                        for future in done:
+                            del in_flight[future]
+                        if failed_query is not None:
+                            break
+                    in_flight[executor.submit (self.__run_query, query,
+                                                      template="insert_data")] = query
+
+                done, _ = wait (in_flight)
+                if failed_query is None:
+                    failed_query = next((in_flight[future] for future in done
+                                         if not future.result()), None)
+        else:
+            # The in-process store applies all batches at once, so readers
+            # never see part of the triples and they are committed together.
+            with self.__store_lock ("update"):
+                for query in self.__insert_queries (lines):
+                    if not self.__run_query (query, template="insert_data"):
+                        failed_query = query
+                        break
+
+        if failed_query is None:
             return True
 
         self.log.error ("Inserting triples from a graph failed.")
-        self.__log_query (query)
+        self.__log_query (failed_query)
 
         return False
 
@@ -256,7 +642,8 @@ class SparqlInterface:
         """"Returns True of the state-graph is already initialized."""
         query = ((f'ASK {{ GRAPH <{self.state_graph}> {{ <this> '
                   f'<{rdf.FDF["initialized"]}> "true"^^<{XSD.boolean}> }} }}'))
-        return self.__run_query (query)
+        # A lagging replica would make the state graph look uninitialized.
+        return self.__run_query (query, template="state_graph_is_initialized", primary=True)
 
     def initialize_database (self):
         """Procedure to initialize the database."""
@@ -266,63 +653,184 @@ class SparqlInterface:
             self.log.info ("Skipping re-initialization of the state-graph.")
             return True
 
-        graph = Graph ()
+        graph = rdf.TripleBuilder ()
         delft_uri = rdf.unique_node ("institution")
-        rdf.add (graph, delft_uri, RDF.type, rdf.FDF["Institution"], "uri")
-        rdf.add (graph, delft_uri, RDFS.label, "Delft University of Technology", XSD.string)
+        graph.add (delft_uri, RDF.type, rdf.FDF["Institution"], "uri")
+        graph.add (delft_uri, RDFS.label, "Delft University of Technology", XSD.string)
 
         twente_uri = rdf.unique_node ("institution")
-        rdf.add (graph, twente_uri, RDF.type, rdf.FDF["Institution"], "uri")
-        rdf.add (graph, twente_uri, RDFS.label, "University of Twente", XSD.string)
+        graph.add (twente_uri, RDF.type, rdf.FDF["Institution"], "uri")
+        graph.add (twente_uri, RDFS.label, "University of Twente", XSD.string)
 
         wageningen_uri = rdf.unique_node ("institution")
-        rdf.add (graph, wageningen_uri, RDF.type, rdf.FDF["Institution"], "uri")
-        rdf.add (graph, wageningen_uri, RDFS.label, "Wageningen University & Research", XSD.string)
+        graph.add (wageningen_uri, RDF.type, rdf.FDF["Institution"], "uri")
+        graph.add (wageningen_uri, RDFS.label, "Wageningen University & Research", XSD.string)
 
         eindhoven_uri = rdf.unique_node ("institution")
-        rdf.add (graph, eindhoven_uri, RDF.type, rdf.FDF["Institution"], "uri")
-        rdf.add (graph, eindhoven_uri, RDFS.label, "Eindhoven University of Technology", XSD.string)
+        graph.add (eindhoven_uri, RDF.type, rdf.FDF["Institution"], "uri")
+        graph.add (eindhoven_uri, RDFS.label, "Eindhoven University of Technology", XSD.string)
 
-        rdf.add (graph, URIRef("this"), rdf.FDF["initialized"], True, XSD.boolean)
+        graph.add (URIRef("this"), rdf.FDF["initialized"], True, XSD.boolean)
 
-        query = self.__insert_query_for_graph (graph)
-        result = self.__run_query (query)
+        query = graph.insert_query (self.state_graph)
+        result = self.__run_query (query, template="insert_data")
+        if result:
+            self.reload_reference_data ()
         return bool(result)
 
+    def reload_reference_data (self):
+        """
+        Procedure to replace the in-memory snapshot of reference data, like
+        the institutions, with their current state in the SPARQL endpoint.
+        """
+        query   = self.query_from_template ("institutions")
+        records = self.__run_query (query, template="institutions")
+        if not records:
+            self.log.warning ("No institutions found; keeping the previous set.")
+            return False
+
+        # Readers share the snapshot, so it must not be modified in place.
+        self.institutions_snapshot = tuple (MappingProxyType (record)
+                                            for record in records)
+        self.log.info ("Loaded %d institutions.", len(self.institutions_snapshot))
+        return True
+
     def institutions (self):
-        """Returns a list of institutions."""
-        query = self.__query_from_template ("institutions")
-        self.__log_query (query)
-        return self.__run_query (query)
+        """Returns a tuple of institutions."""
+        if self.institutions_snapshot is None:
+            self.reload_reference_data ()
+        if self.institutions_snapshot is None:
+            return ()
+        return self.institutions_snapshot
+
+    def __applications_cache_prefix (self, application_uuid=None, account_uuid=None):
+        """
+        Returns the cache prefix for reading the applications of
+        APPLICATION_UUID as seen by ACCOUNT_UUID, or None when not cacheable.
+        """
+        for uuid in (application_uuid, account_uuid):
+            if uuid is not None and not validator.is_valid_uuid (uuid):
+                return None
+
+        # Prefixes are nested, so that invalidating "applications_<uuid>"
+        # also drops what each reviewer sees of that application.
+        reader = "all" if account_uuid is None else account_uuid
+        if application_uuid is None:
+            return f"applications_list_{reader}"
+        return f"applications_{application_uuid}_{reader}"
+
+    def invalidate_application_cache (self, application_uuid=None, reviewer_uuid=None):
+        """
+        Procedure to remove the cached reads that a write to the application
+        identified by APPLICATION_UUID affects.  When REVIEWER_UUID is given,
+        only the reads of that reviewer are removed.
+        """
+        if reviewer_uuid is None:
+            if application_uuid is not None:
+                self.cache.invalidate_by_prefix (f"applications_{application_uuid}")
+            self.cache.invalidate_by_prefix ("applications_list")
+        else:
+            if application_uuid is not None:
+                self.cache.invalidate_by_prefix (
+                    f"applications_{application_uuid}_{reviewer_uuid}")
+            self.cache.invalidate_by_prefix (f"applications_list_{reviewer_uuid}")
+
+        return True
+
+    def __flush_pending_updates (self, application_uuid=None, is_submitted=False):
+        """Procedure to write pending updates that a read could observe."""
+        if self.write_behind is None:
+            return None
+
+        # Submitting bypasses the queue, so only drafts can be pending.
+        if application_uuid is not None:
+            self.write_behind.flush (application_uuid)
+        elif not is_submitted:
+            self.write_behind.flush ()
+
+        return None
 
     def applications (self, application_uuid=None, account_uuid=None, is_submitted=False):
         """Returns a list of application records."""
-        query = self.__query_from_template ("applications", {
+        self.__flush_pending_updates (application_uuid, is_submitted)
+        query = self.query_from_template ("applications", {
             "account_uuid": account_uuid,
             "uuid": application_uuid,
+            "uuids": None,
             "is_submitted": is_submitted
         })
-        return self.__run_query (query)
+        prefix = self.__applications_cache_prefix (application_uuid, account_uuid)
+        if prefix is None:
+            return self.__run_query (query, template="applications")
+        return self.__run_query (query, query, prefix, "applications")
+
+    def iterate_applications (self, application_uuid=None, account_uuid=None, is_submitted=False):
+        """
+        Yields application records one at a time, while they are being
+        received from the SPARQL endpoint.  Unlike 'applications', the records
+        are not cached, and a failing query raises its error.
+        """
+        self.__flush_pending_updates (application_uuid, is_submitted)
+        query = self.query_from_template ("applications", {
+            "account_uuid": account_uuid,
+            "uuid": application_uuid,
+            "uuids": None,
+            "is_submitted": is_submitted
+        })
+        return self.__iterate_query (query, "applications")
+
+    def applications_by_uuids (self, application_uuids, account_uuid=None, is_submitted=False):
+        """Returns the application records for APPLICATION_UUIDS in a single query."""
+
+        uuids = [uuid for uuid in application_uuids if validator.is_valid_uuid (uuid)]
+        if not uuids:
+            return []
+
+        if not is_submitted:
+            for uuid in uuids:
+                self.__flush_pending_updates (uuid)
+
+        query = self.query_from_template ("applications", {
+            "account_uuid": account_uuid,
+            "uuid": None,
+            "uuids": uuids,
+            "is_submitted": is_submitted
+        })
+        prefix = self.__applications_cache_prefix (None, account_uuid)
+        if prefix is None:
+            return self.__run_query (query, template="applications")
+        return self.__run_query (query, query, prefix, "applications")
 
     def ranking (self):
-        """Returns a table with rankings per application."""
-        query = self.__query_from_template ("ranking")
-        return self.__run_query (query)
+        """Returns a table with rankings per application, highest total first."""
+        query = self.query_from_template ("ranking")
+        return self.__run_query (query, query, "ranking", "ranking")
+
+    def rebuild_ranking (self):
+        """Procedure to recompute the ranking scores from all evaluations."""
+        query = self.query_from_template ("rebuild_ranking")
+        if not self.__run_query (query, template="rebuild_ranking"):
+            self.log.error ("Rebuilding the ranking failed.")
+            return False
+
+        self.cache.invalidate_by_prefix ("ranking")
+        return True
 
     def create_application (self):
         """Creates an application entry and returns a unique UUID."""
 
-        graph = Graph()
+        graph = rdf.TripleBuilder ()
         uri = rdf.unique_node ("application")
 
         current_epoch = int(datetime.now().timestamp())
-        rdf.add (graph, uri, RDF.type,                    rdf.FDF["Application"], "uri")
-        rdf.add (graph, uri, rdf.FDF["created_date"],     current_epoch, XSD.integer)
-        rdf.add (graph, uri, rdf.FDF["modified_date"],    current_epoch, XSD.integer)
+        graph.add (uri, RDF.type,                    rdf.FDF["Application"], "uri")
+        graph.add (uri, rdf.FDF["created_date"],     current_epoch, XSD.integer)
+        graph.add (uri, rdf.FDF["modified_date"],    current_epoch, XSD.integer)
 
         if not self.add_triples_from_graph (graph):
             return None
 
+        self.invalidate_application_cache ()
         return rdf.uri_to_uuid (uri)
 
     def update_application_budget_upload (self, application_uuid, budget_filename=None):
@@ -331,12 +839,16 @@ class SparqlInterface:
         APPLICATION_UUID has been updated, False otherwise.
         """
         current_epoch = int(datetime.now().timestamp())
-        query = self.__query_from_template ("update_application_budget_upload", {
+        query = self.query_from_template ("update_application_budget_upload", {
             "uuid"            : application_uuid,
             "budget_filename" : rdf.escape_string_value (budget_filename),
             "modified_date"   : current_epoch
         })
-        return self.__run_query (query)
+        if not self.__run_query (query, template="update_application_budget_upload"):
+            return False
+
+        self.invalidate_application_cache (application_uuid)
+        return True
 
     def update_application (self, application_uuid, name=None, pronouns=None,
                             institution=None, faculty=None, department=None,
@@ -353,56 +865,151 @@ class SparqlInterface:
         Returns True when the application identified by APPLICATION_UUID has
         been updated, False otherwise.
         """
-        current_epoch = int(datetime.now().timestamp())
-        query = self.__query_from_template ("update_application", {
-            "uuid"          : application_uuid,
-            "name"          : rdf.escape_string_value (name),
-            "pronouns"      : rdf.escape_string_value (pronouns),
-            "email"         : rdf.escape_string_value (email),
-            "institution"   : rdf.escape_string_value (institution),
-            "faculty"       : rdf.escape_string_value (faculty),
-            "department"    : rdf.escape_string_value (department),
-            "position"      : rdf.escape_string_value (position),
-            "discipline"    : rdf.escape_string_value (discipline),
-            "datatype"      : rdf.escape_string_value (datatype),
-            "description"   : rdf.escape_string_value (description),
-            "size"          : rdf.escape_string_value (size),
-            "whodoesit"     : rdf.escape_string_value (whodoesit),
-            "achievement"   : rdf.escape_string_value (achievement),
-            "fair_summary"  : rdf.escape_string_value (fair_summary),
-            "findable"      : rdf.escape_string_value (findable),
-            "accessible"    : rdf.escape_string_value (accessible),
-            "interoperable" : rdf.escape_string_value (interoperable),
-            "reusable"      : rdf.escape_string_value (reusable),
-            "summary"       : rdf.escape_string_value (summary),
-            "promotion"     : rdf.escape_string_value (promotion),
-            "linked_publication" : rdf.escape_string_value (linked_publication),
-            "data_timing"   : rdf.escape_string_value (data_timing),
-            "refinement"    : rdf.escape_string_value (refinement),
-            "interview_consent" : rdf.escape_boolean_value (interview_consent),
-            "checkpoints_consent" : rdf.escape_boolean_value (checkpoints_consent),
-            "financial_consent" : rdf.escape_boolean_value (financial_consent),
-            "organization_consent" : rdf.escape_boolean_value (organization_consent),
-            "budget_filename": rdf.escape_string_value (budget_filename),
-            "submitted"     : submitted,
-            "modified_date" : current_epoch
+        fields = {
+            "name":                 name,
+            "pronouns":             pronouns,
+            "email":                email,
+            "institution":          institution,
+            "faculty":              faculty,
+            "department":           department,
+            "position":             position,
+            "discipline":           discipline,
+            "datatype":             datatype,
+            "description":          description,
+            "size":                 size,
+            "whodoesit":            whodoesit,
+            "achievement":          achievement,
+            "fair_summary":         fair_summary,
+            "findable":             findable,
+            "accessible":           accessible,
+            "interoperable":        interoperable,
+            "reusable":             reusable,
+            "summary":              summary,
+            "promotion":            promotion,
+            "linked_publication":   linked_publication,
+            "data_timing":          data_timing,
+            "refinement":           refinement,
+            "interview_consent":    interview_consent,
+            "checkpoints_consent":  checkpoints_consent,
+            "financial_consent":    financial_consent,
+            "organization_consent": organization_consent,
+            "budget_filename":      budget_filename
+        }
+        update = (fields, submitted, int(datetime.now().timestamp()))
+
+        # Drafts are collapsed into one write per interval.  Submitting
+        # replaces any pending draft and is written immediately.  A failed
+        # submission is reported to the user and never retried later, but
+        # the draft it replaced is kept.
+        if self.write_behind is not None:
+            if submitted:
+                return self.write_behind.write (application_uuid, update)
+            self.write_behind.put (application_uuid, update)
+            return True
+
+        return self.__write_application_update (application_uuid, update)
+
+    def __write_application_update (self, application_uuid, update):
+        fields, submitted, modified_date = update
+        # The stored values decide which fields are written, so they must
+        # not come from a replica that has not caught up yet.
+        current = self.application_field_values (
+            self.__run_query (self.application_fields_query (application_uuid),
+                              template="application_fields", primary=True))
+        query = self.update_application_query (application_uuid, fields,
+                                               submitted, modified_date, current)
+        if query is None:
+            return True
+
+        template = "update_application" if current is None else "update_application_fields"
+        if not self.__run_query (query, template=template):
+            return False
+
+        # With a write-behind queue, cached reads stay valid until the
+        # update is actually written.
+        self.invalidate_application_cache (application_uuid)
+        return True
+
+    def application_fields_query (self, application_uuid):
+        """Returns the query for the stored fields of APPLICATION_UUID."""
+        return self.query_from_template ("application_fields", {
+            "uuid": application_uuid
         })
-        return self.__run_query (query)
+
+    def __escaped_field_value (self, field, value):
+        if field in APPLICATION_BOOLEAN_FIELDS:
+            return rdf.escape_boolean_value (value)
+        return rdf.escape_string_value (value)
+
+    def application_field_values (self, rows):
+        """
+        Returns a dictionary of the escaped values per field from the ROWS
+        of an 'application_fields' query, or None when ROWS is empty.
+        """
+        if not rows:
+            return None
+
+        current = {}
+        for row in rows:
+            field = value_or_none (row, "field")
+            if field not in APPLICATION_FORM_FIELDS:
+                continue
+            value = self.__escaped_field_value (field, value_or_none (row, "value"))
+            current.setdefault (field, set()).add (value)
+
+        return current
+
+    def update_application_query (self, application_uuid, fields, submitted=False,
+                                  modified_date=None, current=None):
+        """
+        Returns the query to update the application identified by
+        APPLICATION_UUID with the values in FIELDS.  When CURRENT holds the
+        stored values, as returned by application_field_values, only the
+        fields that differ are rewritten, and None is returned when there
+        is nothing to write.
+        """
+        if modified_date is None:
+            modified_date = int(datetime.now().timestamp())
+
+        parameters = {
+            "uuid":          application_uuid,
+            "submitted":     submitted,
+            "modified_date": modified_date
+        }
+        if current is None:
+            for field in APPLICATION_STRING_FIELDS:
+                parameters[field] = rdf.escape_string_value (value_or_none (fields, field))
+            for field in APPLICATION_BOOLEAN_FIELDS:
+                parameters[field] = rdf.escape_boolean_value (value_or_none (fields, field))
+
+            return self.query_from_template ("update_application", parameters)
+
+        changed_fields = []
+        for field in APPLICATION_FORM_FIELDS:
+            value = self.__escaped_field_value (field, value_or_none (fields, field))
+            if current.get (field, set()) != ({value} - {None}):
+                changed_fields.append ((field, value))
+
+        if not changed_fields and not submitted:
+            return None
+
+        parameters["changed_fields"] = changed_fields
+        return self.query_from_template ("update_application_fields", parameters)
 
     def insert_account (self, email=None, first_name=None, last_name=None, domain=None):
         """Procedure to create an account."""
 
-        graph        = Graph()
+        graph        = rdf.TripleBuilder ()
         account_uri  = rdf.unique_node ("account")
 
         if domain is None and email is not None:
             domain = email.partition("@")[2]
 
-        rdf.add (graph, account_uri, RDF.type,              rdf.FDF["Account"], "uri")
-        rdf.add (graph, account_uri, rdf.FDF["first_name"], first_name, XSD.string)
-        rdf.add (graph, account_uri, rdf.FDF["last_name"],  last_name,  XSD.string)
-        rdf.add (graph, account_uri, rdf.FDF["email"],      email,      XSD.string)
-        rdf.add (graph, account_uri, rdf.FDF["domain"],     domain,     XSD.string)
+        graph.add (account_uri, RDF.type,              rdf.FDF["Account"], "uri")
+        graph.add (account_uri, rdf.FDF["first_name"], first_name, XSD.string)
+        graph.add (account_uri, rdf.FDF["last_name"],  last_name,  XSD.string)
+        graph.add (account_uri, rdf.FDF["email"],      email,      XSD.string)
+        graph.add (account_uri, rdf.FDF["domain"],     domain,     XSD.string)
 
         if self.add_triples_from_graph (graph):
             self.cache.invalidate_by_prefix ("accounts")
@@ -425,16 +1032,16 @@ class SparqlInterface:
 
         current_time = datetime.strftime (datetime.now(), "%Y-%m-%dT%H:%M:%SZ")
 
-        graph       = Graph()
+        graph       = rdf.TripleBuilder ()
         link_uri    = rdf.unique_node ("session")
         account_uri = URIRef(rdf.uuid_to_uri (account_uuid, "account"))
 
-        rdf.add (graph, link_uri, RDF.type,                rdf.FDF["Session"], "uri")
-        rdf.add (graph, link_uri, rdf.FDF["account"],      account_uri,        "uri")
-        rdf.add (graph, link_uri, rdf.FDF["created_date"], current_time,       XSD.dateTime)
-        rdf.add (graph, link_uri, rdf.FDF["name"],         name,               XSD.string)
-        rdf.add (graph, link_uri, rdf.FDF["token"],        token,              XSD.string)
-        rdf.add (graph, link_uri, rdf.FDF["editable"],     editable,           XSD.boolean)
+        graph.add (link_uri, RDF.type,                rdf.FDF["Session"], "uri")
+        graph.add (link_uri, rdf.FDF["account"],      account_uri,        "uri")
+        graph.add (link_uri, rdf.FDF["created_date"], current_time,       XSD.dateTime)
+        graph.add (link_uri, rdf.FDF["name"],         name,               XSD.string)
+        graph.add (link_uri, rdf.FDF["token"],        token,              XSD.string)
+        graph.add (link_uri, rdf.FDF["editable"],     editable,           XSD.boolean)
 
         if self.add_triples_from_graph (graph):
             return token, rdf.uri_to_uuid (link_uri)
@@ -447,26 +1054,48 @@ class SparqlInterface:
         if session_token is None:
             return None
 
-        query = self.__query_from_template ("account_by_session_token", {
+        account = self.session_cache.cached_value (session_token)
+        self.metrics.record_cache_lookup ("account_by_session_token", account is not None)
+        if account is not None:
+            return account
+
+        query = self.query_from_template ("account_by_session_token", {
             "token":       rdf.escape_string_value (session_token),
         })
 
         try:
-            return self.__run_query (query)[0]
+            # The session may have been created a moment ago.
+            account = self.__run_query (query, template="account_by_session_token",
+                                        primary=True)[0]
         except IndexError:
             return None
 
+        return self.session_cache.cache_value (session_token, account)
+
+    def delete_session (self, session_token):
+        """Procedure to remove the session identified by SESSION_TOKEN."""
+
+        if session_token is None:
+            return True
+
+        self.session_cache.remove_cached_value (session_token)
+        query = self.query_from_template ("delete_session", {
+            "token":       rdf.escape_string_value (session_token),
+        })
+
+        return self.__run_query (query, template="delete_session")
+
     def accounts (self, account_uuid=None, order=None, order_direction=None,
                   limit=None, offset=None, email=None, search_for=None):
         """Returns accounts."""
 
-        query = self.__query_from_template ("accounts", {
+        query = self.query_from_template ("accounts", {
             "account_uuid": account_uuid,
             "email": rdf.escape_string_value(email),
             "search_for": rdf.escape_string_value (search_for),
         })
         query += rdf.sparql_suffix (order, order_direction, limit, offset)
-        return self.__run_query (query, query, "accounts")
+        return self.__run_query (query, query, "accounts", "accounts")
 
     def account_by_uuid (self, account_uuid):
         """Returns an account record or None."""
@@ -478,11 +1107,11 @@ class SparqlInterface:
     def account_by_email (self, email):
         """Returns the account matching EMAIL."""
 
-        query = self.__query_from_template ("account_by_email", {
+        query = self.query_from_template ("account_by_email", {
             "email":  rdf.escape_string_value (email)
         })
         try:
-            return self.__run_query (query)[0]
+            return self.__run_query (query, template="account_by_email")[0]
         except IndexError:
             return None
 
@@ -491,24 +1120,35 @@ class SparqlInterface:
                            reusable_score, budget_score, achievement_score, comments):
         """Inserts an application evaluation for the reviewer identified by REVIEWER_UUID."""
 
-        graph           = Graph()
+        graph           = rdf.TripleBuilder ()
         uri             = rdf.unique_node ("evaluation")
         application_uri = rdf.uuid_to_uri (application_uuid, "application")
         reviewer_uri    = rdf.uuid_to_uri (reviewer_uuid, "account")
 
-        rdf.add (graph, uri, RDF.type,                       rdf.FDF["Evaluation"], "uri")
-        rdf.add (graph, uri, rdf.FDF["application"],         application_uri,       "uri")
-        rdf.add (graph, uri, rdf.FDF["reviewer"],            reviewer_uri,          "uri")
-        rdf.add (graph, uri, rdf.FDF["refinement_score"],    refinement_score)
-        rdf.add (graph, uri, rdf.FDF["findable_score"],      findable_score)
-        rdf.add (graph, uri, rdf.FDF["accessible_score"],    accessible_score)
-        rdf.add (graph, uri, rdf.FDF["interoperable_score"], interoperable_score)
-        rdf.add (graph, uri, rdf.FDF["reusable_score"],      reusable_score)
-        rdf.add (graph, uri, rdf.FDF["budget_score"],        budget_score)
-        rdf.add (graph, uri, rdf.FDF["achievement_score"],   achievement_score)
-        rdf.add (graph, uri, rdf.FDF["comments"],            comments)
+        graph.add (uri, RDF.type,                       rdf.FDF["Evaluation"], "uri")
+        graph.add (uri, rdf.FDF["application"],         application_uri,       "uri")
+        graph.add (uri, rdf.FDF["reviewer"],            reviewer_uri,          "uri")
+        graph.add (uri, rdf.FDF["refinement_score"],    refinement_score)
+        graph.add (uri, rdf.FDF["findable_score"],      findable_score)
+        graph.add (uri, rdf.FDF["accessible_score"],    accessible_score)
+        graph.add (uri, rdf.FDF["interoperable_score"], interoperable_score)
+        graph.add (uri, rdf.FDF["reusable_score"],      reusable_score)
+        graph.add (uri, rdf.FDF["budget_score"],        budget_score)
+        graph.add (uri, rdf.FDF["achievement_score"],   achievement_score)
+        graph.add (uri, rdf.FDF["comments"],            comments)
 
         if self.add_triples_from_graph (graph):
-            return rdf.uri_to_uuid (uri)
+            evaluation_uuid = rdf.uri_to_uuid (uri)
+            query = self.query_from_template ("update_ranking_score", {
+                "evaluation_uuid":  evaluation_uuid,
+                "application_uuid": application_uuid
+            })
+            if not self.__run_query (query, template="update_ranking_score"):
+                self.log.error ("Failed to add evaluation %s to the ranking; "
+                                "use --rebuild-ranking to recompute it.", evaluation_uuid)
+
+            self.invalidate_application_cache (application_uuid, reviewer_uuid)
+            self.cache.invalidate_by_prefix ("ranking")
+            return evaluation_uuid
 
         return None
@@ -0,0 +1,113 @@
+"""
+This module provides an append-only journal of the update queries sent to
+the SPARQL endpoint.  Queries are written by a background thread, so that
+request threads never wait for disk I/O.
+"""
+
+import atexit
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+
+class QueryJournal:
+    """
+    This class appends queries with their timestamp to gzip-compressed
+    files in 'directory'.  Every flush interval, the queued queries are
+    compressed as one gzip member, appended and synced to disk with a single
+    fsync.  A new file is started when the current one exceeds 'rotate_size'
+    bytes.
+
+    Each line of the uncompressed journal is a JSON object with a
+    "timestamp" and a "query" key.
+    """
+
+    def __init__ (self, directory, flush_interval=1.0, rotate_size=16777216):
+        self.directory      = directory
+        self.flush_interval = flush_interval
+        self.rotate_size    = rotate_size
+        self.queue          = queue.SimpleQueue()
+        self.stop_event     = threading.Event()
+        self.thread         = None
+        self.filename       = None
+        self.log            = logging.getLogger(__name__)
+
+    def start (self):
+        """Returns True when the journal is ready to accept queries."""
+        if self.thread is not None:
+            return True
+
+        try:
+            os.makedirs (self.directory, mode=0o700, exist_ok=True)
+        except OSError as error:
+            self.log.error ("Cannot create the transactions directory '%s': %s",
+                            self.directory, error)
+            return False
+
+        self.stop_event.clear()
+        self.thread = threading.Thread (target = self.__write_periodically,
+                                        name   = "query-journal",
+                                        daemon = True)
+        self.thread.start()
+        atexit.register (self.stop)
+        return True
+
+    def stop (self):
+        """Procedure to stop the background thread and write all queued queries."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def append (self, query):
+        """Procedure to queue QUERY for writing to the journal."""
+        timestamp = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        self.queue.put ((timestamp, query))
+
+    def __next_filename (self):
+        moment = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+        return os.path.join (self.directory, f"transactions-{moment}.jsonl.gz")
+
+    def flush (self):
+        """Returns True after writing all queued queries to disk, False on failure."""
+        lines = []
+        while True:
+            try:
+                timestamp, query = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            lines.append (json.dumps ({ "timestamp": timestamp, "query": query }))
+
+        if not lines:
+            return True
+
+        if self.filename is None:
+            self.filename = self.__next_filename ()
+
+        # Gzip members can be concatenated, so each batch is appended as a
+        # complete member.  A crash can therefore only lose unsynced batches.
+        member = gzip.compress (("\n".join (lines) + "\n").encode("utf-8"))
+        try:
+            journal_fd = os.open (self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            with open (journal_fd, "ab") as journal_file:
+                journal_file.write (member)
+                journal_file.flush ()
+                os.fsync (journal_file.fileno())
+                size = journal_file.tell ()
+        except OSError as error:
+            self.log.error ("Failed to write %d queries to '%s': %s",
+                            len(lines), self.filename, error)
+            return False
+
+        if size >= self.rotate_size:
+            self.filename = self.__next_filename ()
+
+        return True
+
+    def __write_periodically (self):
+        while not self.stop_event.wait (self.flush_interval):
+            self.flush()
@@ -0,0 +1,345 @@
+"""
+This module provides the RDF stores that run inside the process, and the
+locking needed to share them between request threads.
+"""
+
+import atexit
+import functools
+import logging
+import os
+import re
+import threading
+from contextlib import contextmanager
+from rdflib import Dataset, URIRef
+from rdflib.parser import create_input_source
+from rdflib.plugins.parsers.nquads import NQuadsParser
+from rdflib.plugins.parsers.ntriples import unquote, uriquote
+from rdflib.plugins.sparql import prepareQuery, prepareUpdate
+from rdflib.plugins.stores.berkeleydb import BerkeleyDB
+from rdflib.store import VALID_STORE
+
+## Error handling for loading berkeleydb is done in 'database'.
+try:
+    from berkeleydb import db
+    from rdflib.plugins.stores.berkeleydb import ENVFLAGS, ENVSETFLAGS
+    BERKELEYDB_DEPENDENCY_LOADED = True
+except (ImportError, ModuleNotFoundError):
+    BERKELEYDB_DEPENDENCY_LOADED = False
+
+## rdflib's SPARQL parser keeps state in shared pyparsing objects, so
+## queries can only be parsed one at a time.
+PARSER_LOCK = threading.Lock()
+
+def prepared_query (query, execution_type):
+    """
+    Returns QUERY parsed for evaluation by rdflib, so that the parsing is
+    serialized while the evaluation of queries can run concurrently.
+    """
+    if execution_type == "update":
+        with PARSER_LOCK:
+            return prepareUpdate (query)
+    return prepared_read_query (query)
+
+@functools.lru_cache (maxsize=256)
+def prepared_read_query (query):
+    """
+    Returns the read QUERY parsed for evaluation by rdflib.  Read queries
+    from templates repeat, like the ranking, and parsing them takes longer
+    than evaluating most of them, so their parsed form is reused.  Updates
+    are hardly ever sent twice and are not kept.
+    """
+    with PARSER_LOCK:
+        return prepareQuery (query)
+
+class RelativeNQuadsParser (NQuadsParser):
+    """
+    This class parses N-Quads that may contain relative IRIs, like the
+    <this> node in the state graph, which rdflib's parser rejects.
+    """
+
+    RELATIVE_URIREF = re.compile (r'<([^\s"<>]*)>')
+
+    def uriref (self):
+        if self.peek ("<"):
+            uri = self.eat (self.RELATIVE_URIREF).group(1)
+            return URIRef (uriquote (unquote (uri)))
+        return False
+
+class ReadWriteLock:
+    """
+    This class allows many readers or a single writer at a time.  Waiting
+    writers go before new readers, so a steady stream of reads cannot
+    starve updates.  The writer may re-acquire the lock for reading or
+    writing, but a reader must not acquire it again.
+    """
+
+    def __init__ (self):
+        self.condition       = threading.Condition (threading.Lock())
+        self.readers         = 0
+        self.writer          = None
+        self.writer_depth    = 0
+        self.waiting_writers = 0
+
+    def acquire_read (self):
+        """Procedure to block until the lock is held for reading."""
+        with self.condition:
+            if self.writer == threading.get_ident():
+                self.writer_depth += 1
+                return None
+            while self.writer is not None or self.waiting_writers > 0:
+                self.condition.wait ()
+            self.readers += 1
+        return None
+
+    def release_read (self):
+        """Procedure to release the lock after acquire_read."""
+        with self.condition:
+            if self.writer == threading.get_ident():
+                self.writer_depth -= 1
+                return None
+            self.readers -= 1
+            if self.readers == 0:
+                self.condition.notify_all ()
+        return None
+
+    def acquire_write (self):
+        """Procedure to block until the lock is held for writing."""
+        with self.condition:
+            if self.writer == threading.get_ident():
+                self.writer_depth += 1
+                return None
+            self.waiting_writers += 1
+            while self.writer is not None or self.readers > 0:
+                self.condition.wait ()
+            self.waiting_writers -= 1
+            self.writer       = threading.get_ident()
+            self.writer_depth = 1
+        return None
+
+    def release_write (self):
+        """Procedure to release the lock after acquire_write."""
+        with self.condition:
+            self.writer_depth -= 1
+            if self.writer_depth == 0:
+                self.writer = None
+                self.condition.notify_all ()
+        return None
+
+    def is_outermost_writer (self):
+        """Returns True when the calling thread holds the lock for writing only once."""
+        return self.writer == threading.get_ident() and self.writer_depth == 1
+
+    @contextmanager
+    def reading (self):
+        """Context manager that holds the lock for reading."""
+        self.acquire_read ()
+        try:
+            yield
+        finally:
+            self.release_read ()
+
+    @contextmanager
+    def writing (self):
+        """Context manager that holds the lock for writing."""
+        self.acquire_write ()
+        try:
+            yield
+        finally:
+            self.release_write ()
+
+class BerkeleyDBStore (BerkeleyDB):
+    """
+    This class extends rdflib's BerkeleyDB store with a configurable cache
+    size, a reader/writer lock, and grouped commits.
+
+    rdflib's store is not transactional, so a SPARQL update consists of
+    many separate writes.  Holding the lock for writing keeps readers from
+    seeing an update halfway.  Writes are synced to disk at most once every
+    'commit_interval' seconds, or when the outermost writer releases the
+    lock when 'commit_interval' is 0.
+    """
+
+    def __init__ (self, cache_size=52428800, commit_interval=0.2):
+        super().__init__()
+        self.cache_size      = cache_size
+        self.commit_interval = commit_interval
+        self.lock            = ReadWriteLock()
+        self.needs_commit    = threading.Event()
+        self.stop_event      = threading.Event()
+        self.committer       = None
+        self.log             = logging.getLogger(__name__)
+
+    def _init_db_environment (self, homeDir, create=True):  # pylint: disable=invalid-name
+        """Returns the BerkeleyDB environment for HOMEDIR, using 'cache_size'."""
+        if not os.path.exists (homeDir):
+            if not create:
+                return super()._init_db_environment (homeDir, create)
+            os.mkdir (homeDir)
+            self.create (homeDir)
+
+        db_env = db.DBEnv()
+        db_env.set_cachesize (self.cache_size // 1073741824, self.cache_size % 1073741824)
+        db_env.set_flags (ENVSETFLAGS, 1)
+        db_env.open (homeDir, ENVFLAGS | db.DB_CREATE)
+        return db_env
+
+    def open (self, configuration, create=True):
+        """Returns the status of opening the store at CONFIGURATION."""
+        status = super().open (configuration, create)
+        if status == VALID_STORE and self.commit_interval > 0 and self.committer is None:
+            self.stop_event.clear()
+            self.committer = threading.Thread (target = self.__commit_periodically,
+                                               name   = "berkeleydb-commit",
+                                               daemon = True)
+            self.committer.start()
+            atexit.register (self.stop_committing)
+        return status
+
+    def stop_committing (self):
+        """Procedure to stop the background commits and sync pending writes."""
+        self.stop_event.set()
+        if self.committer is not None:
+            self.committer.join()
+            self.committer = None
+        self.commit ()
+
+    def close (self, commit_pending_transaction=False):
+        """Procedure to sync pending writes and close the store."""
+        self.stop_committing ()
+        super().close (commit_pending_transaction)
+
+    def commit (self):
+        """Procedure to sync the writes since the last commit to disk."""
+        if not self.needs_commit.is_set():
+            return None
+
+        self.needs_commit.clear()
+        with self.lock.reading ():
+            self.sync ()
+        return None
+
+    def reading (self):
+        """Context manager that excludes writers."""
+        return self.lock.reading ()
+
+    @contextmanager
+    def writing (self):
+        """Context manager that excludes readers and other writers."""
+        self.lock.acquire_write ()
+        try:
+            yield
+        finally:
+            if self.lock.is_outermost_writer ():
+                self.needs_commit.set()
+                if self.commit_interval <= 0:
+                    self.commit ()
+            self.lock.release_write ()
+
+    def __commit_periodically (self):
+        while not self.stop_event.wait (self.commit_interval):
+            try:
+                self.commit ()
+            except Exception as error:  # pylint: disable=broad-exception-caught
+                self.log.error ("Committing to BerkeleyDB failed: %s", error)
+
+class MemoryStore:
+    """
+    This class keeps the RDF store in memory, guarded by a reader/writer
+    lock.  It loads 'snapshot_path' on start, and writes the store to it
+    in the N-Quads format every 'snapshot_interval' seconds after updates,
+    and on exit.  Without a 'snapshot_path', nothing is written to disk.
+    """
+
+    def __init__ (self, snapshot_path=None, snapshot_interval=60.0):
+        self.dataset           = Dataset ()
+        self.snapshot_path     = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.lock              = ReadWriteLock()
+        self.needs_snapshot    = threading.Event()
+        self.stop_event        = threading.Event()
+        self.thread            = None
+        self.log               = logging.getLogger(__name__)
+
+    def load (self):
+        """Returns True after loading the snapshot, or when there is none yet."""
+        if self.snapshot_path is None or not os.path.exists (self.snapshot_path):
+            return True
+
+        try:
+            with self.lock.writing ():
+                RelativeNQuadsParser ().parse (create_input_source (location = self.snapshot_path),
+                                               self.dataset)
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            self.log.error ("Loading '%s' failed: %s", self.snapshot_path, error)
+            return False
+
+        self.log.info ("Loaded %d quads from '%s'.", len(self.dataset), self.snapshot_path)
+        return True
+
+    def start (self):
+        """Procedure to start writing snapshots in the background."""
+        if self.snapshot_path is None or self.thread is not None:
+            return None
+
+        atexit.register (self.stop)
+        if self.snapshot_interval <= 0:
+            return None
+
+        self.stop_event.clear()
+        self.thread = threading.Thread (target = self.__snapshot_periodically,
+                                        name   = "memory-store-snapshot",
+                                        daemon = True)
+        self.thread.start()
+        return None
+
+    def stop (self):
+        """Procedure to stop the background snapshots and write a final one."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.snapshot ()
+
+    def snapshot (self):
+        """Returns True when the store has been written to 'snapshot_path'."""
+        if self.snapshot_path is None or not self.needs_snapshot.is_set():
+            return True
+
+        self.needs_snapshot.clear()
+        temporary_path = f"{self.snapshot_path}.tmp"
+        try:
+            with self.lock.reading ():
+                data = self.dataset.serialize (format="nquads", encoding="utf-8")
+
+            # Replace the previous snapshot only after the new one is on disk.
+            snapshot_fd = os.open (temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open (snapshot_fd, "wb") as snapshot_file:
+                snapshot_file.write (data)
+                snapshot_file.flush ()
+                os.fsync (snapshot_file.fileno())
+            os.replace (temporary_path, self.snapshot_path)
+        except OSError as error:
+            self.needs_snapshot.set()
+            self.log.error ("Writing a snapshot to '%s' failed: %s", self.snapshot_path, error)
+            return False
+
+        return True
+
+    def reading (self):
+        """Context manager that excludes writers."""
+        return self.lock.reading ()
+
+    @contextmanager
+    def writing (self):
+        """Context manager that excludes readers and other writers."""
+        self.lock.acquire_write ()
+        try:
+            yield
+        finally:
+            if self.lock.is_outermost_writer ():
+                self.needs_snapshot.set()
+            self.lock.release_write ()
+
+    def __snapshot_periodically (self):
+        while not self.stop_event.wait (self.snapshot_interval):
+            self.snapshot ()
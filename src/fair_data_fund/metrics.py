@@ -0,0 +1,285 @@
+"""
+This module provides in-process counters and latency histograms to find
+out where time is spent, without depending on an external metrics library.
+"""
+
+import threading
+
+## Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """
+    This class counts observations per bucket.  The last bucket counts the
+    observations that exceed the largest bound in 'bounds'.  Callers are
+    responsible for locking.
+    """
+
+    def __init__ (self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total  = 0.0
+        self.count  = 0
+
+    def observe (self, value):
+        """Procedure to add VALUE to the histogram."""
+        index = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.total += value
+        self.count += 1
+
+    def as_dict (self):
+        """Returns the histogram as a dictionary with cumulative bucket counts."""
+        buckets    = {}
+        cumulative = 0
+        for bound, count in zip (self.bounds, self.counts):
+            cumulative += count
+            buckets[bound] = cumulative
+        buckets["+Inf"] = self.count
+        return { "buckets": buckets, "sum": self.total, "count": self.count }
+
+class TemplateStatistics:
+    """This class holds the statistics of the queries from a single template."""
+
+    def __init__ (self):
+        self.calls          = 0
+        self.failures       = 0
+        self.rows           = 0
+        self.cache_hits     = 0
+        self.cache_misses   = 0
+        self.renders        = 0
+        self.render_seconds = 0.0
+        self.slow_queries   = 0
+        self.latency        = Histogram ()
+
+    def as_dict (self):
+        """Returns the statistics as a dictionary."""
+        return {
+            "calls":          self.calls,
+            "failures":       self.failures,
+            "rows":           self.rows,
+            "cache_hits":     self.cache_hits,
+            "cache_misses":   self.cache_misses,
+            "renders":        self.renders,
+            "render_seconds": self.render_seconds,
+            "slow_queries":   self.slow_queries,
+            "latency":        self.latency.as_dict ()
+        }
+
+class QueryMetrics:
+    """
+    This class records per-template call counts, latencies, result row
+    counts and cache hits and misses of the queries sent to the SPARQL
+    endpoint.  Queries that were not rendered from a template are recorded
+    under the name the caller passes, or under 'UNKNOWN_TEMPLATE'.
+    """
+
+    UNKNOWN_TEMPLATE = "ad-hoc"
+
+    def __init__ (self):
+        self.lock      = threading.Lock()
+        self.templates = {}
+
+    def __statistics (self, template):
+        if template is None:
+            template = self.UNKNOWN_TEMPLATE
+        try:
+            return self.templates[template]
+        except KeyError:
+            statistics = TemplateStatistics ()
+            self.templates[template] = statistics
+            return statistics
+
+    def record_render (self, template, seconds):
+        """Procedure to record the rendering of a query from TEMPLATE."""
+        with self.lock:
+            statistics = self.__statistics (template)
+            statistics.renders += 1
+            statistics.render_seconds += seconds
+
+    def record_cache_lookup (self, template, is_hit):
+        """Procedure to record a cache hit or miss for a query from TEMPLATE."""
+        with self.lock:
+            statistics = self.__statistics (template)
+            if is_hit:
+                statistics.cache_hits += 1
+            else:
+                statistics.cache_misses += 1
+
+    def record_query (self, template, seconds, rows=None, failed=False, slow=False):
+        """
+        Procedure to record the execution of a query from TEMPLATE that took
+        SECONDS and returned ROWS rows.
+        """
+        with self.lock:
+            statistics = self.__statistics (template)
+            statistics.calls += 1
+            statistics.latency.observe (seconds)
+            if rows is not None:
+                statistics.rows += rows
+            if failed:
+                statistics.failures += 1
+            if slow:
+                statistics.slow_queries += 1
+
+    def snapshot (self):
+        """Returns a dictionary of the statistics per template."""
+        with self.lock:
+            return { template: statistics.as_dict ()
+                     for template, statistics in sorted (self.templates.items ()) }
+
+    def reset (self):
+        """Procedure to discard all recorded statistics."""
+        with self.lock:
+            self.templates = {}
+
+class ServerMetrics:
+    """
+    This class records the latency and status code of HTTP requests per
+    endpoint, the size of uploaded files and the outcome of sending e-mails.
+    """
+
+    def __init__ (self):
+        self.lock          = threading.Lock()
+        self.latencies     = {}
+        self.responses     = {}
+        self.upload_bytes  = 0
+        self.uploads       = {}
+        self.emails        = {}
+
+    def record_request (self, endpoint, status_code, seconds):
+        """Procedure to record a request to ENDPOINT that took SECONDS."""
+        with self.lock:
+            try:
+                histogram = self.latencies[endpoint]
+            except KeyError:
+                histogram = Histogram ()
+                self.latencies[endpoint] = histogram
+            histogram.observe (seconds)
+            key = (endpoint, status_code)
+            self.responses[key] = self.responses.get (key, 0) + 1
+
+    def record_upload (self, number_of_bytes, is_complete):
+        """Procedure to record an upload of NUMBER_OF_BYTES bytes."""
+        outcome = "complete" if is_complete else "incomplete"
+        with self.lock:
+            self.upload_bytes += number_of_bytes
+            self.uploads[outcome] = self.uploads.get (outcome, 0) + 1
+
+    def record_email (self, is_sent):
+        """Procedure to record the outcome of sending an e-mail."""
+        outcome = "sent" if is_sent else "failed"
+        with self.lock:
+            self.emails[outcome] = self.emails.get (outcome, 0) + 1
+
+    def snapshot (self):
+        """Returns a dictionary of the recorded metrics."""
+        with self.lock:
+            return {
+                "latencies":    { endpoint: histogram.as_dict ()
+                                  for endpoint, histogram in sorted (self.latencies.items ()) },
+                "responses":    dict (sorted (self.responses.items ())),
+                "upload_bytes": self.upload_bytes,
+                "uploads":      dict (sorted (self.uploads.items ())),
+                "emails":       dict (sorted (self.emails.items ()))
+            }
+
+def label_value (value):
+    """Returns VALUE escaped for use as a Prometheus label value."""
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def label_set (labels):
+    """Returns the Prometheus label set for the (name, value) pairs in LABELS."""
+    if not labels:
+        return ""
+    pairs = ",".join (f'{name}="{label_value (value)}"' for name, value in labels)
+    return f"{{{pairs}}}"
+
+def sample_value (value):
+    """Returns VALUE formatted as a Prometheus sample value."""
+    if isinstance (value, float):
+        return repr (value)
+    return str (value)
+
+def append_header (lines, name, metric_type, description):
+    """Procedure to append the HELP and TYPE lines of metric NAME to LINES."""
+    lines.append (f"# HELP {name} {description}")
+    lines.append (f"# TYPE {name} {metric_type}")
+
+def append_histogram (lines, name, labels, histogram):
+    """Procedure to append the samples of HISTOGRAM for metric NAME to LINES."""
+    for bound, count in histogram["buckets"].items ():
+        bucket_labels = labels + [("le", bound if bound == "+Inf" else repr (float (bound)))]
+        lines.append (f"{name}_bucket{label_set (bucket_labels)} {count}")
+    lines.append (f"{name}_sum{label_set (labels)} {sample_value (histogram['sum'])}")
+    lines.append (f"{name}_count{label_set (labels)} {histogram['count']}")
+
+def prometheus_text (server_metrics, query_metrics):
+    """
+    Returns SERVER_METRICS and QUERY_METRICS in the Prometheus text
+    exposition format.
+    """
+    server    = server_metrics.snapshot ()
+    templates = query_metrics.snapshot ()
+    lines     = []
+
+    name = "fair_data_fund_http_request_duration_seconds"
+    append_header (lines, name, "histogram", "Time spent handling HTTP requests per endpoint.")
+    for endpoint, histogram in server["latencies"].items ():
+        append_histogram (lines, name, [("endpoint", endpoint)], histogram)
+
+    name = "fair_data_fund_http_responses_total"
+    append_header (lines, name, "counter", "HTTP responses per endpoint and status code.")
+    for (endpoint, status_code), count in server["responses"].items ():
+        lines.append (f"{name}{label_set ([('endpoint', endpoint), ('code', status_code)])} {count}")
+
+    name = "fair_data_fund_sparql_query_duration_seconds"
+    append_header (lines, name, "histogram", "Time spent executing SPARQL queries per template.")
+    for template, statistics in templates.items ():
+        append_histogram (lines, name, [("template", template)], statistics["latency"])
+
+    counters = [
+        ("fair_data_fund_sparql_query_failures_total", "failures",
+         "Failed SPARQL queries per template."),
+        ("fair_data_fund_sparql_query_rows_total", "rows",
+         "Rows returned by SPARQL queries per template."),
+        ("fair_data_fund_sparql_slow_queries_total", "slow_queries",
+         "SPARQL queries per template that exceeded the slow query threshold."),
+        ("fair_data_fund_sparql_template_renders_total", "renders",
+         "Renderings of SPARQL templates."),
+        ("fair_data_fund_sparql_template_render_seconds_total", "render_seconds",
+         "Time spent rendering SPARQL templates.")
+    ]
+    for name, key, description in counters:
+        append_header (lines, name, "counter", description)
+        for template, statistics in templates.items ():
+            lines.append (f"{name}{label_set ([('template', template)])} "
+                          f"{sample_value (statistics[key])}")
+
+    name = "fair_data_fund_cache_lookups_total"
+    append_header (lines, name, "counter", "Cache lookups per template and result.")
+    for template, statistics in templates.items ():
+        for result, key in (("hit", "cache_hits"), ("miss", "cache_misses")):
+            if statistics["cache_hits"] or statistics["cache_misses"]:
+                labels = [("template", template), ("result", result)]
+                lines.append (f"{name}{label_set (labels)} {statistics[key]}")
+
+    name = "fair_data_fund_upload_bytes_total"
+    append_header (lines, name, "counter", "Bytes received in file uploads.")
+    lines.append (f"{name} {server['upload_bytes']}")
+
+    name = "fair_data_fund_uploads_total"
+    append_header (lines, name, "counter", "File uploads per outcome.")
+    for outcome, count in server["uploads"].items ():
+        lines.append (f"{name}{label_set ([('outcome', outcome)])} {count}")
+
+    name = "fair_data_fund_emails_total"
+    append_header (lines, name, "counter", "E-mails per outcome of sending them.")
+    for outcome, count in server["emails"].items ():
+        lines.append (f"{name}{label_set ([('outcome', outcome)])} {count}")
+
+    return "\n".join (lines) + "\n"
@@ -2,9 +2,12 @@
 This module provides convenience functions for handling RDF.
 """
 
+import codecs
+import json
 import re
 import uuid
-from rdflib import Literal, Namespace, URIRef, XSD
+from rdflib import Literal, Namespace, URIRef, Variable, XSD
+from rdflib.plugins.sparql.results.jsonresults import parseJsonTerm
 
 BLANK = Namespace("blank:")
 FDF   = Namespace("https://ontologies.data.4tu.nl/fair-data-fund/0.0.1/")
@@ -14,11 +17,22 @@ COMMENTS_PATTERN = re.compile(r"(^|\n)\s*#.*?\n")
 PREFIX_PATTERN   = re.compile(
     r"((?P<base>(\s*BASE\s*<.*?>)\s*)|(?P<prefixes>(\s*PREFIX\s+.+:\s*<.*?>)\s*))*"
 )
+BINDINGS_PATTERN = re.compile(r'"bindings"\s*:\s*\[')
 QUERY_PATTERN    = re.compile(
     r"(?P<queryType>(CONSTRUCT|SELECT|ASK|DESCRIBE|INSERT|DELETE|CREATE|CLEAR|DROP|LOAD|COPY|MOVE|ADD))",
     re.VERBOSE | re.IGNORECASE,
 )
 
+## Datatype annotations of the literals serialized by 'escape_value'.
+XSD_STRING_SUFFIX  = f"^^<{XSD.string}>"
+XSD_BOOLEAN_SUFFIX = f"^^<{XSD.boolean}>"
+XSD_INTEGER_SUFFIX = f"^^<{XSD.integer}>"
+TRUE_LITERAL       = f'"true"{XSD_BOOLEAN_SUFFIX}'
+FALSE_LITERAL      = f'"false"{XSD_BOOLEAN_SUFFIX}'
+
+## Characters that rdflib refuses to serialize in an IRI.
+INVALID_URI_PATTERN = re.compile(r'[<>" {}|\\^`]')
+
 def query_type (query):
     """
     Returns two values. The first value is 'update' for state-modifying
@@ -42,6 +56,52 @@ def query_type (query):
 
     return None, None
 
+def iterate_json_bindings (stream, chunk_size=65536):
+    """
+    Yields the bindings of a SPARQL JSON result read from STREAM one at a
+    time, so that the complete result never has to be held in memory.
+    Each binding is a dictionary of rdflib Variables to rdflib terms, like
+    the 'bindings' property of a parsed rdflib Result.
+    """
+
+    decoder      = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer       = ""
+    position     = None
+    end_of_input = False
+
+    while True:
+        if position is None:
+            match = BINDINGS_PATTERN.search (buffer)
+            if match is not None:
+                buffer   = buffer[match.end():]
+                position = 0
+                continue
+        else:
+            # Skip the separators between two bindings.
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer):
+                if buffer[position] == "]":
+                    return None
+                try:
+                    binding, position = decoder.raw_decode (buffer, position)
+                    buffer   = buffer[position:]
+                    position = 0
+                    yield { Variable(name): parseJsonTerm (term)
+                            for name, term in binding.items() }
+                    continue
+                except json.JSONDecodeError:
+                    # The binding is incomplete, so read more input.
+                    pass
+
+        if end_of_input:
+            raise ValueError ("Unexpected end of SPARQL JSON result.")
+
+        chunk = stream.read (chunk_size)
+        end_of_input = not chunk
+        buffer += text_decoder.decode (chunk, final=end_of_input)
+
 def add (graph, subject, predicate, value, datatype=None):
     """Adds the triplet SUBJECT PREDICATE VALUE if VALUE is set."""
     if value is not None:
@@ -78,15 +138,53 @@ def sparql_filter (name, value, escape=False, is_uri=False):
 
     return query
 
+def quote_literal (lexical):
+    """
+    Returns the string LEXICAL wrapped in double quotes, escaped the same
+    way as rdflib's Literal.n3().
+    """
+    if "\n" in lexical:
+        encoded = lexical.replace ("\\", "\\\\")
+        if '"""' in lexical:
+            encoded = encoded.replace ('"""', '\\"\\"\\"')
+        if encoded[-1] == '"' and encoded[-2] != "\\":
+            encoded = encoded[:-1] + '\\"'
+        return '"""' + encoded.replace ("\r", "\\r") + '"""'
+
+    return '"' + (lexical.replace ("\\", "\\\\")
+                         .replace ('"', '\\"')
+                         .replace ("\r", "\\r")) + '"'
+
 def escape_value (value, datatype=None):
     """Returns VALUE wrapped in double quotes with type annotation DATATYPE."""
     if value is None:
         return None
 
+    # Strings, booleans and integers are serialized without constructing
+    # an rdflib Literal.  The output is identical to Literal.n3(), which
+    # handles the other values, including those that rdflib normalizes,
+    # like "1" as xsd:boolean.
+    value_type = type (value)
+    if value_type is str:  # pylint: disable=unidiomatic-typecheck
+        if datatype is None:
+            return quote_literal (value)
+        if datatype == XSD.string:
+            return quote_literal (value) + XSD_STRING_SUFFIX
+        if datatype == XSD.boolean and value in ("true", "false"):
+            return f'"{value}"{XSD_BOOLEAN_SUFFIX}'
+    elif value_type is bool:
+        if datatype is None or datatype == XSD.boolean:
+            return TRUE_LITERAL if value else FALSE_LITERAL
+    elif value_type is int:
+        if datatype is None or datatype == XSD.integer:
+            return f'"{value}"{XSD_INTEGER_SUFFIX}'
+
     return Literal(value, datatype=datatype).n3()
 
 def escape_string_value (value):
     """Returns VALUE wrapped in double quotes and annotated as xsd:string."""
+    if type (value) is str:  # pylint: disable=unidiomatic-typecheck
+        return quote_literal (value) + XSD_STRING_SUFFIX
     return escape_value (value, datatype=XSD.string)
 
 def escape_date_value (value):
@@ -99,6 +197,10 @@ def escape_datetime_value (value):
 
 def escape_boolean_value (value):
     """Returns VALUE wrapped in double quotes and annotated as xsd:date."""
+    if value is True:
+        return TRUE_LITERAL
+    if value is False:
+        return FALSE_LITERAL
     return escape_value (value, datatype=XSD.boolean)
 
 def sparql_in_filter (name, values, escape=False, is_uri=False, negate=False):
@@ -144,16 +246,56 @@ def sparql_suffix (order, order_direction, limit=None, offset=None):
 
     return query
 
-def insert_query (state_graph, rdflib_graph):
-    """Procedure to generate a SPARQL query to insert triplets."""
+def uri_term (value):
+    """Returns VALUE in angle brackets, or raises ValueError like URIRef.n3()."""
+    if INVALID_URI_PATTERN.search (value) is not None:
+        raise ValueError (f'"{value}" does not look like a valid URI.')
+    return f"<{value}>"
+
+class TripleBuilder:
+    """
+    This class collects triples as tuples of subject, predicate, value and
+    datatype, and writes them as N-Triples for an INSERT DATA query without
+    building an rdflib Graph.  Values are serialized like 'add' would store
+    them in a Graph.
+    """
 
-    body  = rdflib_graph.serialize(format="ntriples")
-    if isinstance(body, bytes):
-        body = body.decode('utf-8')
+    def __init__ (self):
+        self.triples = []
 
-    query = f"INSERT DATA {{ GRAPH <{state_graph}> {{ {body} }} }}"
+    def __len__ (self):
+        return len(self.triples)
 
-    return query
+    def add (self, subject, predicate, value, datatype=None):
+        """Adds the triplet SUBJECT PREDICATE VALUE if VALUE is set."""
+        if value is None:
+            return None
+        if isinstance (value, str) and value == "" and datatype == XSD.integer:
+            return None
+
+        self.triples.append ((subject, predicate, value, datatype))
+        return None
+
+    def ntriples_lines (self):
+        """Yields the triples as lines of N-Triples."""
+        for subject, predicate, value, datatype in self.triples:
+            if datatype in ("url", "uri"):
+                noun = uri_term (value)
+            else:
+                noun = escape_value (value, datatype)
+            yield f"{uri_term (subject)} {uri_term (predicate)} {noun} .\n"
+
+    def insert_query (self, state_graph):
+        """Returns a SPARQL query to insert the triples into STATE_GRAPH."""
+        return insert_data_query (state_graph, "".join (self.ntriples_lines ()))
+
+def ntriples_line (subject, predicate, noun):
+    """Returns the triplet SUBJECT PREDICATE NOUN as a line of N-Triples."""
+    return f"{subject.n3()} {predicate.n3()} {noun.n3()} .\n"
+
+def insert_data_query (state_graph, body):
+    """Procedure to generate a SPARQL query to insert the triplets in BODY."""
+    return f"INSERT DATA {{ GRAPH <{state_graph}> {{ {body} }} }}"
 
 def blank_node ():
     """Return a unique blank node."""
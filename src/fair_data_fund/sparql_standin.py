@@ -0,0 +1,241 @@
+"""
+This module provides a stand-in for the SPARQL endpoint, to test and
+benchmark the communication with it without running Virtuoso.  It speaks
+the SPARQL 1.1 protocol as used by 'database', keeps its data in memory,
+and can add latency and inject failures.  Like the queries in 'database',
+INSERT DATA must name a graph, because rdflib cannot insert data into the
+default graph of a Dataset.
+
+Run it with: python -m fair_data_fund.sparql_standin --port 8890
+"""
+
+import argparse
+import json
+import logging
+import random
+import signal
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from fair_data_fund import local_store
+
+class StandinSparqlServer (ThreadingHTTPServer):
+    """
+    This class serves SPARQL queries and updates from a MemoryStore.
+
+    Every request is delayed by 'latency' seconds plus up to 'jitter'
+    seconds.  A fraction 'error_rate' of the requests is answered with
+    '503 Service Unavailable', and a fraction 'timeout_rate' is held for
+    'timeout_delay' seconds before it is answered, so that clients with a
+    shorter deadline time out.
+    """
+
+    daemon_threads      = True
+    allow_reuse_address = True
+
+    def __init__ (self, address="127.0.0.1", port=8890, store=None):
+        super().__init__ ((address, port), StandinRequestHandler)
+        self.store         = store if store is not None else local_store.MemoryStore ()
+        self.latency       = 0.0
+        self.jitter        = 0.0
+        self.error_rate    = 0.0
+        self.timeout_rate  = 0.0
+        self.timeout_delay = 30.0
+        self.random        = random.Random ()
+        self.lock          = threading.Lock()
+        self.statistics    = { "queries": 0, "updates": 0, "errors": 0,
+                               "injected_errors": 0, "injected_timeouts": 0 }
+        self.log           = logging.getLogger(__name__)
+        self.thread        = None
+
+    @property
+    def url (self):
+        """Returns the URL of the SPARQL endpoint."""
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/sparql"
+
+    def count (self, key):
+        """Procedure to increment the statistic KEY."""
+        with self.lock:
+            self.statistics[key] += 1
+
+    def injected_failure (self):
+        """Returns 'error', 'timeout' or None for the next request."""
+        with self.lock:
+            draw = self.random.random ()
+        if draw < self.error_rate:
+            self.count ("injected_errors")
+            return "error"
+        if draw < self.error_rate + self.timeout_rate:
+            self.count ("injected_timeouts")
+            return "timeout"
+        return None
+
+    def delay (self):
+        """Returns the number of seconds to wait before answering."""
+        with self.lock:
+            return self.latency + self.random.uniform (0, self.jitter)
+
+    def start (self):
+        """Procedure to serve requests from a background thread."""
+        self.thread = threading.Thread (target = self.serve_forever,
+                                        name   = "sparql-standin",
+                                        daemon = True)
+        self.thread.start()
+
+    def stop (self):
+        """Procedure to stop serving and close the socket."""
+        self.shutdown ()
+        self.server_close ()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+class StandinRequestHandler (BaseHTTPRequestHandler):
+    """This class implements the SPARQL 1.1 protocol for StandinSparqlServer."""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message (self, format, *args):  # pylint: disable=redefined-builtin
+        self.server.log.debug ("%s - %s", self.address_string(), format % args)
+
+    def __respond (self, status_code, body=b"", content_type="text/plain; charset=utf-8"):
+        # Status line, headers and body are written in a single send, so
+        # that responses on a kept-alive connection are not held back by
+        # Nagle's algorithm waiting for the acknowledgement of the headers.
+        reason = self.responses.get (status_code, ("",))[0]
+        head   = (f"{self.protocol_version} {status_code} {reason}\r\n"
+                  f"Content-Type: {content_type}\r\n"
+                  f"Content-Length: {len(body)}\r\n"
+                  "\r\n")
+        try:
+            self.wfile.write (head.encode("latin-1") + body)
+        except OSError:
+            # The client gave up, for example after an injected timeout.
+            self.close_connection = True
+            return None
+        self.log_request (status_code, len(body))
+        return None
+
+    def __read_body (self):
+        length = int(self.headers.get ("Content-Length", 0))
+        return self.rfile.read (length) if length > 0 else b""
+
+    def __operation (self, parameters, body):
+        """Returns a tuple of the execution type and the text of the operation."""
+        content_type = self.headers.get ("Content-Type", "").split(";")[0].strip()
+        if content_type == "application/sparql-query":
+            return "gather", body.decode("utf-8")
+        if content_type == "application/sparql-update":
+            return "update", body.decode("utf-8")
+        if content_type == "application/x-www-form-urlencoded":
+            parameters = { **parameters, **parse_qs (body.decode("utf-8")) }
+
+        if "update" in parameters:
+            return "update", parameters["update"][0]
+        if "query" in parameters:
+            return "gather", parameters["query"][0]
+        return None, None
+
+    def __handle (self, body):
+        parameters = parse_qs (urlparse (self.path).query)
+        execution_type, operation = self.__operation (parameters, body)
+        if operation is None:
+            self.server.count ("errors")
+            return self.__respond (400, b"Missing query or update.\n")
+
+        time.sleep (self.server.delay ())
+        failure = self.server.injected_failure ()
+        if failure == "error":
+            return self.__respond (503, b"Service unavailable (injected).\n")
+        if failure == "timeout":
+            time.sleep (self.server.timeout_delay)
+
+        store = self.server.store
+        try:
+            prepared = local_store.prepared_query (operation, execution_type)
+            if execution_type == "update":
+                self.server.count ("updates")
+                with store.writing ():
+                    store.dataset.update (prepared)
+                return self.__respond (204)
+
+            self.server.count ("queries")
+            with store.reading ():
+                results = store.dataset.query (prepared)
+                if prepared.algebra.name in ("ConstructQuery", "DescribeQuery"):
+                    return self.__respond (200, results.serialize (format="nt", encoding="utf-8"),
+                                           "application/n-triples")
+                output = results.serialize (format="json", encoding="utf-8")
+            return self.__respond (200, output, "application/sparql-results+json")
+        except Exception as error:  # pylint: disable=broad-exception-caught
+            self.server.count ("errors")
+            return self.__respond (400, f"{type(error).__name__}: {error}\n".encode("utf-8"))
+
+    def do_GET (self):  # pylint: disable=invalid-name
+        """Implements queries in the query string, and /statistics."""
+        if urlparse (self.path).path == "/statistics":
+            with self.server.lock:
+                output = json.dumps (self.server.statistics).encode("utf-8")
+            return self.__respond (200, output, "application/json")
+        return self.__handle (b"")
+
+    def do_POST (self):  # pylint: disable=invalid-name
+        """Implements queries and updates in the request body."""
+        return self.__handle (self.__read_body ())
+
+def main ():
+    """The entry point to run the stand-in from the command line."""
+
+    logging.basicConfig(format='[%(levelname)s] %(asctime)s - %(name)s: %(message)s',
+                        level=logging.INFO)
+    logger = logging.getLogger (__name__)
+    parser = argparse.ArgumentParser(
+        prog        = 'python -m fair_data_fund.sparql_standin',
+        description = 'Serve a stand-in SPARQL endpoint from memory.')
+
+    parser.add_argument('--address',       type=str,   default="127.0.0.1")
+    parser.add_argument('--port',          type=int,   default=8890)
+    parser.add_argument('--data',          type=str,   default=None,
+                        help='N-Quads file to load, and to write back on exit.')
+    parser.add_argument('--latency',       type=float, default=0.0,
+                        help='Seconds to wait before answering each request.')
+    parser.add_argument('--jitter',        type=float, default=0.0,
+                        help='Up to this many seconds are added to the latency.')
+    parser.add_argument('--error-rate',    type=float, default=0.0,
+                        help='Fraction of requests answered with 503.')
+    parser.add_argument('--timeout-rate',  type=float, default=0.0,
+                        help='Fraction of requests held for --timeout-delay seconds.')
+    parser.add_argument('--timeout-delay', type=float, default=30.0)
+    parser.add_argument('--seed',          type=int,   default=None,
+                        help='Seed for the injected latency and failures.')
+    arguments = parser.parse_args()
+
+    store = local_store.MemoryStore (arguments.data, snapshot_interval=0)
+    if not store.load ():
+        return 1
+    store.start ()
+
+    server = StandinSparqlServer (arguments.address, arguments.port, store)
+    server.latency       = arguments.latency
+    server.jitter        = arguments.jitter
+    server.error_rate    = arguments.error_rate
+    server.timeout_rate  = arguments.timeout_rate
+    server.timeout_delay = arguments.timeout_delay
+    server.random.seed (arguments.seed)
+
+    signal.signal (signal.SIGTERM, lambda sig, frame: sys.exit (0))
+    logger.info ("Serving SPARQL at %s.", server.url)
+    try:
+        server.serve_forever ()
+    except (KeyboardInterrupt, SystemExit):
+        logger.info ("Received shutdown signal.  Goodbye!")
+    finally:
+        server.server_close ()
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit (main ())
@@ -6,6 +6,7 @@ import argparse
 import signal
 import sys
 import logging
+import threading
 import os
 import json
 import importlib.metadata
@@ -13,7 +14,7 @@ import importlib.metadata
 from defusedxml import ElementTree
 from werkzeug.serving import run_simple
 from rdflib.plugins.stores import berkeleydb
-from fair_data_fund import wsgi
+from fair_data_fund import async_database, wsgi
 from fair_data_fund.convenience import value_or_none, add_logging_level, index_exists
 
 # Even though we don't use these imports in 'ui', the state of
@@ -59,7 +60,8 @@ Available options:
   --help               -h  Show this message.
   --version            -v  Show versioning information.
   --config-file=ARG    -c Load configuration from a file.
-  --initialize         -i Populate the RDF store with default triples.\n""")
+  --initialize         -i Populate the RDF store with default triples.
+  --rebuild-ranking       Recompute the ranking scores from all evaluations.\n""")
     sys.exit(0)
 
 
@@ -70,6 +72,40 @@ def sigint_handler (sig, frame):  # pylint: disable=unused-argument
     sys.exit(0)
 
 
+def register_reload_handler (server, logger):
+    """
+    Procedure to reload the reference data of SERVER on SIGHUP.  The signal
+    handler only wakes up a worker thread, because the reload (and even
+    logging) may wait for locks held by the thread the signal interrupted.
+    """
+
+    reload_requested = threading.Event()
+
+    def sighup_handler (sig, frame):  # pylint: disable=unused-argument
+        reload_requested.set ()
+
+    def reload_when_requested ():
+        while True:
+            reload_requested.wait ()
+            reload_requested.clear ()
+            logger.info ("Received reload signal.  Reloading reference data.")
+            server.db.reload_reference_data ()
+
+    if not hasattr (signal, "SIGHUP"):
+        return None
+
+    try:
+        signal.signal (signal.SIGHUP, sighup_handler)
+    except ValueError:
+        logger.warning ("Cannot reload reference data on SIGHUP from this thread.")
+        return None
+
+    threading.Thread (target = reload_when_requested,
+                      name   = "reference-data-reload",
+                      daemon = True).start()
+    return None
+
+
 def config_value (xml_root, path, command_line=None, fallback=None, return_node=False):
     """Procedure to get the value a config item should have at run-time."""
 
@@ -322,6 +358,28 @@ def configure_file_logging (log_file, inside_reload, logger):
             log.removeHandler(handler)
         log.addHandler(file_handler)
 
+def configure_slow_query_logging (log_file, slow_query_log, inside_reload, logger):
+    """Procedure to write the messages of SLOW_QUERY_LOG to LOG_FILE only."""
+    log_file = os.path.abspath (log_file)
+    try:
+        file_handler = logging.FileHandler (log_file, 'a')
+    except OSError:
+        if not inside_reload:
+            logger.warning ("Cannot write slow queries to '%s'.", log_file)
+        return None
+
+    formatter = logging.Formatter('[%(levelname)s] %(asctime)s - %(name)s: %(message)s')
+    file_handler.setFormatter(formatter)
+    for handler in slow_query_log.handlers[:]:
+        slow_query_log.removeHandler(handler)
+        handler.close()
+    slow_query_log.addHandler(file_handler)
+    slow_query_log.propagate = False
+    if not inside_reload:
+        logger.info ("Writing slow queries to '%s'.", log_file)
+
+    return None
+
 def read_automatic_login_configuration (server, xml_root):
     """Procedure to parse and set automatic login for development setups."""
     automatic_login_email = config_value (xml_root, "authentication/automatic-login-email")
@@ -394,6 +452,17 @@ def read_configuration_file (config, server, config_file, logger, config_files):
         elif server.db.cache.storage is None:
             server.db.cache.storage = os.path.join (server.db.storage, "cache")
 
+        session_cache = xml_root.find ("session-cache")
+        if session_cache is not None:
+            try:
+                server.db.session_cache.ttl = int(session_cache.attrib.get("ttl",
+                                                  server.db.session_cache.ttl))
+                server.db.session_cache.maximum_size = int(session_cache.attrib.get(
+                    "maximum-size", server.db.session_cache.maximum_size))
+            except ValueError:
+                logger.warning ("Invalid value for the 'ttl' or 'maximum-size' attribute in 'session-cache'.")
+                logger.warning ("Using the default session cache settings.")
+
         production_mode = xml_root.find ("production")
         if production_mode is not None:
             server.in_production = bool(int(production_mode.text))
@@ -401,12 +470,33 @@ def read_configuration_file (config, server, config_file, logger, config_files):
         enable_query_audit_log = xml_root.find ("enable-query-audit-log")
         if enable_query_audit_log is not None:
             config["transactions_directory"] = enable_query_audit_log.attrib.get("transactions-directory")
+            server.db.transactions_directory = config["transactions_directory"]
+            try:
+                server.db.journal_flush_interval = float(enable_query_audit_log.attrib.get(
+                    "flush-interval", server.db.journal_flush_interval))
+                server.db.journal_rotate_size = int(enable_query_audit_log.attrib.get(
+                    "rotate-size", server.db.journal_rotate_size))
+            except ValueError:
+                logger.warning ("Invalid value for the 'flush-interval' or 'rotate-size' attribute in 'enable-query-audit-log'.")
+                logger.warning ("Using the default query audit log settings.")
             server.db.enable_query_audit_log = read_boolean_value (xml_root, "enable-query-audit-log",
                                                                    True, logger)
 
         server.allow_crawlers = read_boolean_value (xml_root, "allow-crawlers",
                                                     server.allow_crawlers, logger)
 
+        metrics = xml_root.find ("metrics")
+        if metrics is not None:
+            server.metrics_enabled = read_boolean_value (xml_root, "metrics", True, logger)
+            server.metrics_token = metrics.attrib.get("token", server.metrics_token)
+            allowed_addresses = metrics.attrib.get("allowed-addresses")
+            if allowed_addresses is not None:
+                server.metrics_allowed_addresses = allowed_addresses.split()
+            if (server.metrics_enabled and server.metrics_token is None
+                and not server.metrics_allowed_addresses):
+                logger.warning ("The 'metrics' option requires a 'token' or 'allowed-addresses' attribute.")
+                logger.warning ("Access to /metrics will be denied.")
+
         server.submissions_open = read_boolean_value (xml_root, "submissions-open",
                                                       server.submissions_open, logger)
 
@@ -427,6 +517,133 @@ def read_configuration_file (config, server, config_file, logger, config_files):
         if update_endpoint:
             server.db.update_endpoint = update_endpoint
 
+        for read_endpoint in xml_root.findall ("rdf-store/sparql-read-uri"):
+            if read_endpoint.text and read_endpoint.text not in server.db.read_endpoints:
+                server.db.read_endpoints.append (read_endpoint.text)
+
+        cool_down = config_value (xml_root, "rdf-store/read-endpoint-cool-down")
+        if cool_down is not None:
+            try:
+                server.db.read_endpoint_cool_down = float(cool_down)
+            except ValueError:
+                logger.warning ("Invalid value for 'rdf-store/read-endpoint-cool-down'.")
+                logger.warning ("Skipping failed read endpoints for %s seconds.",
+                                server.db.read_endpoint_cool_down)
+
+        replica_lag = config_value (xml_root, "rdf-store/replica-lag")
+        if replica_lag is not None:
+            try:
+                server.db.replica_lag = float(replica_lag)
+            except ValueError:
+                logger.warning ("Invalid value for 'rdf-store/replica-lag'.")
+                logger.warning ("Reading from the primary for %s seconds after writes.",
+                                server.db.replica_lag)
+
+        connection_pool_size = config_value (xml_root, "rdf-store/connection-pool-size")
+        if connection_pool_size is not None:
+            try:
+                server.db.connection_pool_size = int(connection_pool_size)
+            except ValueError:
+                logger.warning ("Invalid value for 'rdf-store/connection-pool-size'.")
+                logger.warning ("Using a pool of %d connections.", server.db.connection_pool_size)
+
+        insert_batch_size = config_value (xml_root, "rdf-store/insert-batch-size")
+        if insert_batch_size is not None:
+            try:
+                server.db.insert_batch_size = int(insert_batch_size)
+            except ValueError:
+                logger.warning ("Invalid value for 'rdf-store/insert-batch-size'.")
+                logger.warning ("Using batches of %d bytes.", server.db.insert_batch_size)
+
+        insert_parallelism = config_value (xml_root, "rdf-store/insert-parallelism")
+        if insert_parallelism is not None:
+            try:
+                server.db.insert_parallelism = int(insert_parallelism)
+            except ValueError:
+                logger.warning ("Invalid value for 'rdf-store/insert-parallelism'.")
+                logger.warning ("Sending one batch at a time.")
+
+        write_behind_interval = config_value (xml_root, "rdf-store/write-behind-interval")
+        if write_behind_interval is not None:
+            try:
+                server.db.write_behind_interval = float(write_behind_interval)
+            except ValueError:
+                logger.warning ("Invalid value for 'rdf-store/write-behind-interval'.")
+                logger.warning ("Writing application updates immediately.")
+
+        query_retries = config_value (xml_root, "rdf-store/retries")
+        if query_retries is not None:
+            try:
+                server.db.query_retries = int(query_retries)
+            except ValueError:
+                logger.warning ("Invalid value for 'rdf-store/retries'.")
+                logger.warning ("Retrying queries up to %d times.", server.db.query_retries)
+
+        retry_delay = config_value (xml_root, "rdf-store/retry-delay")
+        if retry_delay is not None:
+            try:
+                server.db.retry_delay = float(retry_delay)
+            except ValueError:
+                logger.warning ("Invalid value for 'rdf-store/retry-delay'.")
+                logger.warning ("Using an initial retry delay of %s seconds.",
+                                server.db.retry_delay)
+
+        maximum_retry_delay = config_value (xml_root, "rdf-store/maximum-retry-delay")
+        if maximum_retry_delay is not None:
+            try:
+                server.db.maximum_retry_delay = float(maximum_retry_delay)
+            except ValueError:
+                logger.warning ("Invalid value for 'rdf-store/maximum-retry-delay'.")
+                logger.warning ("Waiting at most %s seconds between retries.",
+                                server.db.maximum_retry_delay)
+
+        query_timeout = config_value (xml_root, "rdf-store/query-timeout")
+        if query_timeout is not None:
+            try:
+                server.db.query_timeout = float(query_timeout)
+            except ValueError:
+                logger.warning ("Invalid value for 'rdf-store/query-timeout'.")
+                logger.warning ("Queries will not time out.")
+
+        bdb_cache_size = config_value (xml_root, "rdf-store/bdb-cache-size")
+        if bdb_cache_size is not None:
+            try:
+                server.db.bdb_cache_size = int(bdb_cache_size)
+            except ValueError:
+                logger.warning ("Invalid value for 'rdf-store/bdb-cache-size'.")
+                logger.warning ("Using a BerkeleyDB cache of %d bytes.", server.db.bdb_cache_size)
+
+        bdb_commit_interval = config_value (xml_root, "rdf-store/bdb-commit-interval")
+        if bdb_commit_interval is not None:
+            try:
+                server.db.bdb_commit_interval = float(bdb_commit_interval)
+            except ValueError:
+                logger.warning ("Invalid value for 'rdf-store/bdb-commit-interval'.")
+                logger.warning ("Committing BerkeleyDB writes every %s seconds.",
+                                server.db.bdb_commit_interval)
+
+        snapshot_interval = config_value (xml_root, "rdf-store/snapshot-interval")
+        if snapshot_interval is not None:
+            try:
+                server.db.snapshot_interval = float(snapshot_interval)
+            except ValueError:
+                logger.warning ("Invalid value for 'rdf-store/snapshot-interval'.")
+                logger.warning ("Writing snapshots of the in-memory RDF store every %s seconds.",
+                                server.db.snapshot_interval)
+
+        slow_query_threshold = config_value (xml_root, "rdf-store/slow-query-threshold")
+        if slow_query_threshold is not None:
+            try:
+                server.db.slow_query_threshold = float(slow_query_threshold)
+            except ValueError:
+                logger.warning ("Invalid value for 'rdf-store/slow-query-threshold'.")
+                logger.warning ("Slow queries will not be logged.")
+
+        slow_query_log = config_value (xml_root, "rdf-store/slow-query-log")
+        if slow_query_log is not None:
+            configure_slow_query_logging (slow_query_log, server.db.slow_query_log,
+                                          inside_reload, logger)
+
         ranking_reviewers = xml_root.find ("ranking-reviewers")
         if ranking_reviewers is not None:
             for account in ranking_reviewers:
@@ -472,6 +689,61 @@ def read_configuration_file (config, server, config_file, logger, config_files):
     return config
 
 
+def setup_server (config_file, logger):
+    """
+    Returns a WebUserInterfaceServer configured from CONFIG_FILE, along with
+    the parsed configuration and the set of configuration files read.
+    """
+
+    config = {}
+    server = wsgi.WebUserInterfaceServer ()
+    config_files = set()
+    config = read_configuration_file (config, server, config_file, logger, config_files)
+
+    if (isinstance (server.db.endpoint, str) and
+        server.db.endpoint.startswith("bdb://") and
+        not berkeleydb.has_bsddb):
+        logger.error(("Configured a BerkeleyDB database back-end, "
+                      "but BerkeleyDB is not installed on the system "
+                      "or the 'berkeleydb' Python package is missing."))
+        raise DependencyNotAvailable
+
+    server.db.setup_sparql_endpoint ()
+    server.db.reload_reference_data ()
+    setup_saml_service_provider (server, logger)
+
+    if server.identity_provider == "automatic-login":
+        server.db.insert_account (email      = server.automatic_login_email,
+                                  first_name = "Automatic",
+                                  last_name  = "User")
+
+    return server, config, config_files
+
+
+def asgi_application ():
+    """
+    Returns the ASGI entry point of a server configured from the file in
+    the FAIR_DATA_FUND_CONFIG_FILE environment variable.  Use it with an
+    ASGI server, like: uvicorn --factory fair_data_fund.ui:asgi_application
+    """
+
+    add_logging_level ("ACCESS", logging.INFO + 5)
+    add_logging_level ("STORE", logging.INFO + 4)
+    logger = logging.getLogger (__name__)
+    server, _, _ = setup_server (os.environ.get ("FAIR_DATA_FUND_CONFIG_FILE"), logger)
+    register_reload_handler (server, logger)
+    if not async_database.AIOHTTP_DEPENDENCY_LOADED:
+        logger.warning ("Missing aiohttp dependency, which the 'asgi' extra installs: "
+                        "pip install 'fair-data-fund[asgi]'.")
+        logger.warning ("All requests will be handled in a thread pool.")
+
+    # A plain coroutine function lets ASGI servers detect the ASGI 3 interface.
+    async def application (scope, receive, send):
+        return await server.asgi (scope, receive, send)
+
+    return application
+
+
 def main_inner ():
     """The main entry point of the program."""
 
@@ -491,6 +763,7 @@ def main_inner ():
     parser.add_argument('--version',     '-v', action='store_true')
     parser.add_argument('--config-file', '-c', type=str, default=None)
     parser.add_argument('--initialize',  '-i', action='store_true')
+    parser.add_argument('--rebuild-ranking',    action='store_true')
 
     # When using PyInstaller and Nuitka, argv[0] seems to get duplicated.
     # In the case of Nuitka, relative paths are converted to absolute paths.
@@ -510,33 +783,20 @@ def main_inner ():
         print("Try --help for usage options.")
         return None
     try:
-        config = {}
-        server = wsgi.WebUserInterfaceServer ()
-        config_files = set()
-        config = read_configuration_file (config, server, arguments.config_file, logger, config_files)
-
-        if (isinstance (server.db.endpoint, str) and
-            server.db.endpoint.startswith("bdb://") and
-            not berkeleydb.has_bsddb):
-            logger.error(("Configured a BerkeleyDB database back-end, "
-                          "but BerkeleyDB is not installed on the system "
-                          "or the 'berkeleydb' Python package is missing."))
-            raise DependencyNotAvailable
-
-        server.db.setup_sparql_endpoint ()
-        setup_saml_service_provider (server, logger)
-
-        if server.identity_provider == "automatic-login":
-            server.db.insert_account (email      = server.automatic_login_email,
-                                      first_name = "Automatic",
-                                      last_name  = "User")
-
+        server, config, config_files = setup_server (arguments.config_file, logger)
         if arguments.initialize:
             logger.info ("Initialization complete.")
             server.db.initialize_database ()
             server.db.sparql.close()
             return None
 
+        if arguments.rebuild_ranking:
+            if server.db.rebuild_ranking ():
+                logger.info ("Rebuilding the ranking complete.")
+            server.db.sparql.close()
+            return None
+
+        register_reload_handler (server, logger)
         run_simple (config["address"], config["port"], server,
                     threaded=True,
                     processes=1,
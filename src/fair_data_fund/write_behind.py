@@ -0,0 +1,134 @@
+"""
+This module provides a write-behind queue that collapses bursts of writes
+to the same record into a single write per flush interval.
+"""
+
+import atexit
+import logging
+import threading
+
+class WriteBehindQueue:
+    """
+    This class keeps the latest pending value per key in memory and passes
+    it to 'write_procedure' every 'interval' seconds, or sooner when a key
+    is flushed explicitly.  Writes are executed one at a time, so an older
+    value can never overwrite a newer one.  A value that fails to be
+    written is retried in the next interval, and dropped after
+    'max_attempts' failed writes.
+    """
+
+    def __init__ (self, write_procedure, interval=2.0, max_attempts=5):
+        self.write_procedure = write_procedure
+        self.interval        = interval
+        self.max_attempts    = max_attempts
+        self.pending         = {}
+        self.attempts        = {}
+        self.lock            = threading.Lock()
+        self.write_lock      = threading.Lock()
+        self.stop_event      = threading.Event()
+        self.thread          = None
+        self.log             = logging.getLogger(__name__)
+
+    def start (self):
+        """Procedure to start flushing in the background."""
+        if self.thread is not None:
+            return None
+
+        self.stop_event.clear()
+        self.thread = threading.Thread (target = self.__flush_periodically,
+                                        name   = "write-behind",
+                                        daemon = True)
+        self.thread.start()
+        atexit.register (self.stop)
+        return None
+
+    def stop (self):
+        """Procedure to stop the background thread and write all pending values."""
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def put (self, key, value):
+        """Procedure to replace the pending value for KEY with VALUE."""
+        with self.lock:
+            self.pending[key] = value
+            self.attempts.pop (key, None)
+
+    def has_pending (self, key=None):
+        """Returns True when a value for KEY, or any value, is pending."""
+        with self.lock:
+            if key is None:
+                return bool(self.pending)
+            return key in self.pending
+
+    def flush (self, key=None):
+        """
+        Returns True after writing the pending value for KEY, or all pending
+        values when KEY is None, and False when a write failed.
+        """
+        with self.write_lock:
+            with self.lock:
+                if key is None:
+                    items = list(self.pending.items())
+                    self.pending.clear()
+                elif key in self.pending:
+                    items = [(key, self.pending.pop (key))]
+                else:
+                    items = []
+
+            succeeded = True
+            for item_key, value in items:
+                if self.write_procedure (item_key, value):
+                    with self.lock:
+                        self.attempts.pop (item_key, None)
+                else:
+                    succeeded = False
+                    self.log.error ("Writing pending value for %s failed.", item_key)
+                    self.__retry (item_key, value)
+
+            return succeeded
+
+    def write (self, key, value):
+        """
+        Returns True after writing VALUE for KEY right away, in place of the
+        pending value for KEY.  When the write fails, VALUE is not retried,
+        and the pending value it replaced is restored.
+        """
+        with self.write_lock:
+            with self.lock:
+                replaced = self.pending.pop (key, None)
+
+            if self.write_procedure (key, value):
+                with self.lock:
+                    self.attempts.pop (key, None)
+                return True
+
+            self.log.error ("Writing the value for %s failed.", key)
+            if replaced is not None:
+                with self.lock:
+                    self.pending.setdefault (key, replaced)
+            return False
+
+    def __retry (self, key, value):
+        """Procedure to queue VALUE for KEY again unless it failed too often."""
+        with self.lock:
+            if key in self.pending:
+                # A newer value arrived, which replaces the failed one.
+                return None
+
+            attempts = self.attempts.get (key, 0) + 1
+            if attempts >= self.max_attempts:
+                self.attempts.pop (key, None)
+                self.log.error ("Dropped the pending value for %s after %d failed writes.",
+                                key, attempts)
+                return None
+
+            self.pending[key]  = value
+            self.attempts[key] = attempts
+        return None
+
+    def __flush_periodically (self):
+        while not self.stop_event.wait (self.interval):
+            self.flush()
@@ -1,8 +1,13 @@
 """This module implements the entire HTTP interface."""
 
+import asyncio
+import hmac
+import itertools
 import json
 import os
 import logging
+import time
+from io import BytesIO
 from werkzeug.utils import redirect, send_file
 from werkzeug.wrappers import Request, Response
 from werkzeug.routing import Map, Rule
@@ -10,9 +15,11 @@ from werkzeug.middleware.shared_data import SharedDataMiddleware
 from werkzeug.exceptions import HTTPException, NotFound, BadRequest
 from jinja2 import Environment, FileSystemLoader
 from jinja2.exceptions import TemplateNotFound
+from fair_data_fund import async_database
 from fair_data_fund import database
 from fair_data_fund import validator
 from fair_data_fund import email_handler
+from fair_data_fund import metrics
 from fair_data_fund.convenience import value_or_none, value_or
 
 ## Error handling for loading python3-saml is done in 'ui'.
@@ -49,6 +56,7 @@ class WebUserInterfaceServer:
             R("/review/<uuid>",                         self.ui_review_application),
             R("/review/budget/<uuid>",                  self.ui_review_application_budget),
             R("/ranking",                               self.ui_ranking),
+            R("/metrics",                               self.metrics_text),
             R("/robots.txt",                            self.robots_txt),
             R("/saml/metadata",                         self.saml_metadata),
             R("/saml/login",                            self.ui_login),
@@ -58,6 +66,7 @@ class WebUserInterfaceServer:
         self.base_url         = f"http://{address}:{port}"
         self.cookie_key       = "ssi_session"
         self.db               = database.SparqlInterface()  # pylint: disable=invalid-name
+        self.async_db         = None
         self.email            = email_handler.EmailInterface()
         self.repositories     = {}
         self.identity_provider = None
@@ -87,12 +96,159 @@ class WebUserInterfaceServer:
         self.log              = logging.getLogger(__name__)
         self.wsgi             = SharedDataMiddleware(self.__respond, self.static_roots)
         self.using_uwsgi      = False
+        self.metrics          = metrics.ServerMetrics()
+        self.metrics_enabled  = False
+        self.metrics_token    = None
+        self.metrics_allowed_addresses = []
 
         logging.getLogger('werkzeug').setLevel(logging.ERROR)
 
     def __call__ (self, environ, start_response):
         return self.wsgi (environ, start_response)
 
+    async def asgi (self, scope, receive, send):
+        """
+        Entry point for ASGI servers.  Saving an application form is handled
+        without blocking a thread.  All other requests are passed on to the
+        WSGI application in a thread pool.
+        """
+
+        if scope["type"] == "lifespan":
+            return await self.__asgi_lifespan (receive, send)
+
+        if scope["type"] != "http":
+            return None
+
+        body      = b""
+        more_body = True
+        while more_body:
+            message   = await receive ()
+            body     += message.get ("body", b"")
+            more_body = message.get ("more_body", False)
+
+        environ  = self.__asgi_environ (scope, body)
+        response = None
+        if scope["method"] == "PUT" and self.__async_db () is not None:
+            response = await self.__asgi_application_form (environ)
+
+        if response is None:
+            loop = asyncio.get_running_loop ()
+            status, headers, content = await loop.run_in_executor (None, self.__run_wsgi, environ)
+        else:
+            status  = response.status_code
+            headers = response.headers.to_wsgi_list ()
+            content = response.get_data ()
+
+        await send ({
+            "type":    "http.response.start",
+            "status":  status,
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                        for name, value in headers]
+        })
+        await send ({ "type": "http.response.body", "body": content })
+        return None
+
+    def __async_db (self):
+        """Returns the AsyncSparqlInterface, or None when it cannot be used."""
+        if (self.async_db is None and
+            async_database.AIOHTTP_DEPENDENCY_LOADED and
+            self.db.store is not None):
+            self.async_db = async_database.AsyncSparqlInterface (self.db)
+
+        return self.async_db
+
+    async def __asgi_lifespan (self, receive, send):
+        while True:
+            message = await receive ()
+            if message["type"] == "lifespan.startup":
+                self.__async_db ()
+                await send ({ "type": "lifespan.startup.complete" })
+            elif message["type"] == "lifespan.shutdown":
+                if self.async_db is not None:
+                    await self.async_db.close ()
+                await send ({ "type": "lifespan.shutdown.complete" })
+                return None
+
+    def __asgi_environ (self, scope, body):
+        """Returns a WSGI environment for the ASGI connection SCOPE."""
+        server  = scope.get ("server") or ("127.0.0.1", 80)
+        client  = scope.get ("client") or ("127.0.0.1", 0)
+        environ = {
+            "REQUEST_METHOD":    scope["method"],
+            "SCRIPT_NAME":       scope.get ("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO":         scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING":      scope.get ("query_string", b"").decode("latin-1"),
+            "SERVER_NAME":       server[0],
+            "SERVER_PORT":       str(server[1]),
+            "SERVER_PROTOCOL":   f"HTTP/{scope.get ('http_version', '1.1')}",
+            "REMOTE_ADDR":       client[0],
+            "CONTENT_LENGTH":    str(len(body)),
+            "wsgi.version":      (1, 0),
+            "wsgi.url_scheme":   scope.get ("scheme", "http"),
+            "wsgi.input":        BytesIO (body),
+            "wsgi.errors":       BytesIO (),
+            "wsgi.multithread":  True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once":     False
+        }
+        for name, value in scope.get ("headers", []):
+            name  = name.decode("latin-1").upper().replace("-", "_")
+            value = value.decode("latin-1")
+            if name == "CONTENT_TYPE":
+                environ["CONTENT_TYPE"] = value
+            elif name != "CONTENT_LENGTH":
+                key = f"HTTP_{name}"
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+        return environ
+
+    def __run_wsgi (self, environ):
+        """Returns the status, headers and body of the WSGI response for ENVIRON."""
+        response_start = {}
+
+        def start_response (status, headers, exc_info=None):  # pylint: disable=unused-argument
+            response_start["status"]  = int(status.split(" ")[0])
+            response_start["headers"] = headers
+
+        output = self (environ, start_response)
+        try:
+            content = b"".join (output)
+        finally:
+            if hasattr (output, "close"):
+                output.close ()
+
+        return response_start["status"], response_start["headers"], content
+
+    async def __asgi_application_form (self, environ):
+        """Implements saving /application-form/<uuid> without blocking, or returns None."""
+
+        if not self.submissions_open or self.maintenance_mode:
+            return None
+
+        try:
+            adapter = self.url_map.bind_to_environ (environ)
+            endpoint, values = adapter.match() #  pylint: disable=unpacking-non-sequence
+        except HTTPException:
+            return None
+
+        uuid = value_or_none (values, "uuid")
+        if endpoint != self.ui_application_form or not validator.is_valid_uuid (uuid):
+            return None
+
+        started = time.monotonic()
+        request = Request (environ)
+        self.log_access (request)
+        response = self.__application_form_parameters (request, uuid)
+        if not isinstance (response, Response):
+            if await self.async_db.update_application (**response):
+                response = self.respond_204 ()
+            else:
+                response = self.error_500 ()
+
+        self.metrics.record_request (endpoint.__name__, response.status_code,
+                                     time.monotonic() - started)
+        return response
+
     def __dispatch_request (self, request):
         adapter = self.url_map.bind_to_environ(request.environ)
         try:
@@ -100,6 +256,7 @@ class WebUserInterfaceServer:
             if self.maintenance_mode:
                 return self.ui_maintenance (request)
             endpoint, values = adapter.match() #  pylint: disable=unpacking-non-sequence
+            request.environ["fair_data_fund.endpoint"] = endpoint.__name__
             return endpoint (request, **values)
         except NotFound:
             return self.error_404 (request)
@@ -115,8 +272,11 @@ class WebUserInterfaceServer:
             raise error
 
     def __respond (self, environ, start_response):
+        started  = time.monotonic()
         request  = Request(environ)
         response = self.__dispatch_request(request)
+        self.metrics.record_request (environ.get ("fair_data_fund.endpoint", "unmatched"),
+                                     response.status_code, time.monotonic() - started)
         return response(environ, start_response)
 
     def __render_template (self, request, template_name, **context):
@@ -133,6 +293,40 @@ class WebUserInterfaceServer:
 
         return self.error_500 ()
 
+    def __render_template_stream (self, request, template_name, **context):
+        """
+        Returns a response that renders TEMPLATE_NAME while it is being sent,
+        so that iterators in CONTEXT are consumed one item at a time.
+        """
+        try:
+            template   = self.jinja.get_template (template_name)
+            parameters = {
+                "base_url":     self.base_url,
+                "path":         request.path
+            }
+            stream = template.stream({ **context, **parameters })
+            stream.enable_buffering (size=64)
+            return self.response (stream, mimetype='text/html')
+        except TemplateNotFound:
+            self.log.error ("Jinja2 template not found: '%s'.", template_name)
+
+        return self.error_500 ()
+
+    def __prefetched (self, rows):
+        """
+        Returns ROWS after reading its first row, so that a failing query is
+        noticed before the response starts, or None when the query failed.
+        """
+        try:
+            first = next (rows)
+        except StopIteration:
+            return iter (())
+        except Exception:  # pylint: disable=broad-exception-caught
+            # The database layer has logged the error.
+            return None
+
+        return itertools.chain ((first,), rows)
+
     # REQUEST CHECKERS
     # -------------------------------------------------------------------------
 
@@ -450,6 +644,42 @@ class WebUserInterfaceServer:
 
         return record
 
+    def __metrics_access_allowed (self, request):
+        """
+        Returns True when REQUEST may read the metrics.  Without a configured
+        token or list of allowed addresses, nobody may, because behind a
+        reverse proxy every request appears to come from the loopback address.
+        """
+        if not self.metrics_allowed_addresses and self.metrics_token is None:
+            return False
+
+        if self.metrics_allowed_addresses:
+            if request.remote_addr not in self.metrics_allowed_addresses:
+                return False
+
+        if self.metrics_token is not None:
+            authorization = value_or (request.headers, "Authorization", "")
+            if not hmac.compare_digest (authorization.encode("utf-8"),
+                                        f"Bearer {self.metrics_token}".encode("utf-8")):
+                return False
+
+        return True
+
+    def metrics_text (self, request):
+        """Implements /metrics."""
+
+        if not self.metrics_enabled:
+            return self.error_404 (request)
+
+        if request.method not in ("GET", "HEAD"):
+            return self.error_405 (["GET", "HEAD"])
+
+        if not self.__metrics_access_allowed (request):
+            return self.error_403 (request)
+
+        output = metrics.prometheus_text (self.metrics, self.db.metrics)
+        return self.response (output, mimetype="text/plain; version=0.0.4")
+
     def robots_txt (self, request):  # pylint: disable=unused-argument
         """Implements /robots.txt."""
 
@@ -594,11 +824,13 @@ class WebUserInterfaceServer:
                 self.log.error ("Expected different end after file contents: '%s' != '%s'.",
                                 ending, expected_end)
 
+        self.metrics.record_upload (file_size, is_incomplete != 1)
         self.db.update_application_budget_upload (application_uuid = uuid,
                                                   budget_filename  = filename)
         return self.respond_201 ()
 
-    def __handle_application_form (self, request, uuid, submit=False):
+    def __application_form_parameters (self, request, uuid, submit=False):
+        """Returns the validated form fields in REQUEST or an error response."""
         record     = request.get_json ()
         errors     = []
         data_timing_options = ["decades-ago", "years-ago", "recent", "ongoing"]
@@ -664,6 +896,13 @@ class WebUserInterfaceServer:
         if errors:
             return self.error_400_list (request, errors)
 
+        return parameters
+
+    def __handle_application_form (self, request, uuid, submit=False):
+        parameters = self.__application_form_parameters (request, uuid, submit)
+        if isinstance (parameters, Response):
+            return parameters
+
         if self.db.update_application (**parameters):
             return True
 
@@ -675,6 +914,9 @@ class WebUserInterfaceServer:
         if not self.submissions_open:
             return self.error_403 (request)
 
+        if uuid is not None and not validator.is_valid_uuid (uuid):
+            return self.error_403 (request)
+
         if request.method in ("GET", "HEAD"):
             if not self.accepts_html (request):
                 return self.error_406 ("text/html")
@@ -768,7 +1010,9 @@ class WebUserInterfaceServer:
                     email_template = self.jinja.get_template ("application-form-submitted.html")
                     html = email_template.render(**parameters)
                     subject = "We received your application for the 4TU.ResearchData FAIR Data Found."
-                    if not self.email.send_email (application["email"], subject, None, html):
+                    is_sent = self.email.send_email (application["email"], subject, None, html)
+                    self.metrics.record_email (is_sent)
+                    if not is_sent:
                         self.log.error ("Failed to send confirmation e-mail to %s.", application["email"])
 
                 return self.__render_template (request,
@@ -802,11 +1046,15 @@ class WebUserInterfaceServer:
             if not self.accepts_html (request):
                 return self.error_406 ("text/html")
 
-            applications = self.db.applications (account_uuid = account_uuid,
-                                                 is_submitted = True)
-            return self.__render_template (request,
-                                           "review/dashboard.html",
-                                           applications = applications)
+            applications = self.__prefetched (self.db.iterate_applications (
+                account_uuid = account_uuid,
+                is_submitted = True))
+            if applications is None:
+                return self.error_500 ()
+
+            return self.__render_template_stream (request,
+                                                  "review/dashboard.html",
+                                                  applications = applications)
 
         return self.error_500 ()
 
@@ -817,6 +1065,9 @@ class WebUserInterfaceServer:
         if account_uuid is None:
             return self.error_authorization_failed (request)
 
+        if not validator.is_valid_uuid (uuid):
+            return self.error_404 (request)
+
         if request.method in ("GET", "HEAD"):
             if not self.accepts_html (request):
                 return self.error_406 ("text/html")
@@ -861,6 +1112,9 @@ class WebUserInterfaceServer:
         if account_uuid is None:
             return self.error_authorization_failed (request)
 
+        if not validator.is_valid_uuid (uuid):
+            return self.error_404 (request)
+
         if request.method in ("GET", "HEAD"):
             try:
                 application = self.db.applications (uuid, account_uuid, True)[0]
@@ -892,24 +1146,10 @@ class WebUserInterfaceServer:
             if not self.accepts_html (request):
                 return self.error_406 ("text/html")
 
-            try:
-                ranking = self.db.ranking ()
-                if not ranking:
-                    return self.__render_template (request, "ranking.html", ranking=[])
-
-                for record in ranking:
-                    record["total_score"] = (value_or (record, "budget_score",        0) +
-                                             value_or (record, "achievement_score",   0) +
-                                             value_or (record, "refinement_score",    0) +
-                                             value_or (record, "findable_score",      0) +
-                                             value_or (record, "accessible_score",    0) +
-                                             value_or (record, "interoperable_score", 0) +
-                                             value_or (record, "reusable_score",      0))
-
-                ranking = sorted (ranking, key = lambda x: x["total_score"], reverse=True)
-                return self.__render_template (request, "ranking.html", ranking = ranking)
-            except IndexError:
-                return self.error_404 (request)
+            # The ranking scores, including their totals, are maintained
+            # when evaluations are inserted, and come sorted by total.
+            ranking = self.db.ranking ()
+            return self.__render_template (request, "ranking.html", ranking = ranking)
 
     def ui_login (self, request):
         """Implements /login."""
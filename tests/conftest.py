@@ -0,0 +1,38 @@
+"""
+Makes the package in 'src' importable when the tests run from a checkout,
+and provides a stand-in SPARQL endpoint for the tests that need one.
+"""
+
+import os
+import sys
+import pytest
+
+sys.path.insert (0, os.path.join (os.path.dirname (os.path.dirname (os.path.abspath (__file__))), "src"))
+
+from fair_data_fund import database, sparql_standin  # pylint: disable=wrong-import-position
+
+STATE_GRAPH = "https://fair-data-fund.invalid/tests"
+
+@pytest.fixture
+def standin ():
+    """Yields a stand-in SPARQL endpoint on an ephemeral port."""
+    server = sparql_standin.StandinSparqlServer (port=0)
+    server.random.seed (0)
+    server.timeout_delay = 2.0
+    server.start ()
+    yield server
+    server.stop ()
+
+@pytest.fixture
+def standin_database (standin):
+    """Yields a SparqlInterface on the 'standin' endpoint, with its reference data."""
+    db = database.SparqlInterface ()
+    db.endpoint               = standin.url
+    db.state_graph            = STATE_GRAPH
+    db.enable_query_audit_log = False
+    db.retry_delay            = 0.01
+    db.maximum_retry_delay    = 0.05
+    db.setup_sparql_endpoint ()
+    assert db.initialize_database ()
+    yield db
+    db.store.close ()
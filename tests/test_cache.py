@@ -0,0 +1,60 @@
+"""Tests that invalidating a prefix keeps stale query results out of the cache."""
+
+import os
+import threading
+from fair_data_fund import cache as cache_module
+from fair_data_fund.cache import CacheLayer
+
+def test_invalidation_during_a_query_skips_the_store (tmp_path):
+    """A value read before an invalidation must not be cached after it."""
+    cache      = CacheLayer (str (tmp_path))
+    prefix     = "applications_list_reviewer"
+    key        = cache.make_key ("query")
+    generation = cache.generation (prefix)
+
+    cache.invalidate_by_prefix ("applications_list")
+    cache.cache_value (prefix, key, ["stale"], generation=generation)
+    assert cache.cached_value (prefix, key) is None
+
+    cache.cache_value (prefix, key, ["fresh"], generation=cache.generation (prefix))
+    assert cache.cached_value (prefix, key) == ["fresh"]
+
+def test_unrelated_invalidation_keeps_the_store (tmp_path):
+    """Invalidating another prefix does not affect the generation of PREFIX."""
+    cache      = CacheLayer (str (tmp_path))
+    prefix     = "applications_list_reviewer"
+    key        = cache.make_key ("query")
+    generation = cache.generation (prefix)
+
+    cache.invalidate_by_prefix ("ranking")
+    cache.invalidate_by_prefix ("applications_list_other")
+    cache.cache_value (prefix, key, ["value"], generation=generation)
+    assert cache.cached_value (prefix, key) == ["value"]
+
+def test_invalidation_between_check_and_write (tmp_path, monkeypatch):
+    """
+    An invalidation that starts after the generation check of a store, but
+    before its file is written, must still remove that file.
+    """
+    cache        = CacheLayer (str (tmp_path))
+    prefix       = "applications_list_reviewer"
+    key          = cache.make_key ("query")
+    generation   = cache.generation (prefix)
+    original     = os.open
+    invalidation = threading.Thread (target=cache.invalidate_by_prefix,
+                                     args=("applications_list",))
+
+    def open_during_invalidation (path, *args, **kwargs):
+        if invalidation.ident is None:
+            invalidation.start ()
+            # Without the lock, the invalidation finishes in this window.
+            invalidation.join (timeout=0.2)
+        return original (path, *args, **kwargs)
+
+    monkeypatch.setattr (cache_module.os, "open", open_during_invalidation)
+    cache.cache_value (prefix, key, ["stale"], generation=generation)
+    monkeypatch.undo ()
+    invalidation.join ()
+
+    assert cache.generation (prefix) != generation
+    assert cache.cached_value (prefix, key) is None
@@ -0,0 +1,78 @@
+"""
+Tests that the serialization in 'rdf' produces the same output as rdflib,
+which it re-implements to avoid constructing rdflib terms.
+"""
+
+import logging
+import warnings
+from contextlib import contextmanager
+import pytest
+from hypothesis import given, settings, strategies as st
+from rdflib import Graph, Literal, RDF, XSD
+from fair_data_fund import rdf
+
+## Text biased towards the characters that need escaping.
+TEXT = st.text (alphabet = st.sampled_from (list ('ab"\\\n\r\t\' é')) | st.characters (),
+                max_size = 200)
+
+VALUES = st.one_of (TEXT, st.booleans (), st.integers (),
+                    st.sampled_from (["", "true", "false", "1", "0", "True",
+                                      '"', '\n"', '"""', '\\\n"']))
+
+DATATYPES = st.sampled_from ([None, XSD.string, XSD.boolean, XSD.integer,
+                              XSD.date, XSD.dateTime])
+
+@contextmanager
+def quiet_rdflib ():
+    """Context manager that hides rdflib's complaints about ill-typed values."""
+    logging.disable (logging.CRITICAL)
+    try:
+        with warnings.catch_warnings ():
+            warnings.simplefilter ("ignore")
+            yield
+    finally:
+        logging.disable (logging.NOTSET)
+
+@settings (max_examples=2000)
+@given (VALUES, DATATYPES)
+def test_escape_value_matches_literal_n3 (value, datatype):
+    """escape_value must be byte-identical to Literal.n3()."""
+    with quiet_rdflib ():
+        assert rdf.escape_value (value, datatype) == Literal (value, datatype=datatype).n3()
+
+@settings (max_examples=1000)
+@given (VALUES)
+def test_typed_escape_functions_match_literal_n3 (value):
+    """The typed escape functions must be byte-identical to Literal.n3()."""
+    with quiet_rdflib ():
+        assert rdf.escape_string_value (value) == Literal (value, datatype=XSD.string).n3()
+        assert rdf.escape_boolean_value (value) == Literal (value, datatype=XSD.boolean).n3()
+
+@given (TEXT)
+def test_quote_literal_matches_literal_n3 (value):
+    """quote_literal must quote plain strings like Literal.n3()."""
+    assert rdf.quote_literal (value) == Literal (value).n3()
+
+@settings (max_examples=1000)
+@given (st.lists (st.tuples (st.none () | VALUES, DATATYPES), max_size=8))
+def test_triple_builder_matches_graph (values):
+    """TripleBuilder must write the same N-Triples lines as an rdflib Graph."""
+    subject = rdf.unique_node ("session")
+    graph   = Graph ()
+    triples = rdf.TripleBuilder ()
+    with quiet_rdflib ():
+        for index, (value, datatype) in enumerate (values):
+            rdf.add (graph, subject, rdf.FDF[f"field_{index}"], value, datatype)
+            triples.add (subject, rdf.FDF[f"field_{index}"], value, datatype)
+        rdf.add (graph, subject, RDF.type, rdf.FDF["Session"], "uri")
+        triples.add (subject, RDF.type, rdf.FDF["Session"], "uri")
+
+        expected = sorted (rdf.ntriples_line (*triple) for triple in graph)
+        assert sorted (triples.ntriples_lines ()) == expected
+
+def test_triple_builder_rejects_invalid_uris ():
+    """TripleBuilder must refuse the IRIs that URIRef.n3() refuses."""
+    triples = rdf.TripleBuilder ()
+    triples.add (rdf.unique_node ("session"), RDF.type, "not a uri", "uri")
+    with pytest.raises (ValueError):
+        list (triples.ntriples_lines ())
@@ -0,0 +1,120 @@
+"""
+Tests the retries, deadlines and read-endpoint failover of the SPARQL
+client against the stand-in endpoint, with injected failures and latency.
+"""
+
+import socket
+import time
+import pytest
+from fair_data_fund import connection_pool, sparql_standin
+
+QUERY = "SELECT ?s WHERE { ?s ?p ?o } LIMIT 1"
+
+def unused_url ():
+    """Returns the URL of a local port on which nothing listens."""
+    with socket.socket () as sock:
+        sock.bind (("127.0.0.1", 0))
+        port = sock.getsockname ()[1]
+    return f"http://127.0.0.1:{port}/sparql"
+
+def failures (db, template):
+    """Returns the number of failed queries from TEMPLATE."""
+    return db.metrics.snapshot ()[template]["failures"]
+
+def test_retries_503_until_the_endpoint_answers (standin, standin_database):
+    """Queries answered with 503 are retried with backoff until they succeed."""
+    # With this seed, the first three requests are answered with 503.
+    standin.error_rate = 0.5
+    standin.random.seed (4)
+    assert standin_database.reload_reference_data ()
+    assert standin.statistics["injected_errors"] == 3
+    assert failures (standin_database, "institutions") == 0
+
+def test_gives_up_after_the_last_retry (standin, standin_database):
+    """A query is sent once plus 'query_retries' times, then reported as failed."""
+    standin_database.query_retries = 3
+    standin.error_rate = 1.0
+    assert not standin_database.reload_reference_data ()
+    assert standin.statistics["injected_errors"] == 4
+    assert failures (standin_database, "institutions") == 1
+
+def test_backoff_stops_at_the_deadline (standin, standin_database):
+    """No retry is scheduled beyond the deadline of the query."""
+    standin_database.query_retries       = 100
+    standin_database.retry_delay         = 0.1
+    standin_database.maximum_retry_delay = 0.1
+    standin_database.query_timeout       = 0.3
+    standin.error_rate = 1.0
+
+    started = time.monotonic ()
+    assert not standin_database.reload_reference_data ()
+    assert time.monotonic () - started < 0.6
+    assert standin.statistics["injected_errors"] < 100
+
+def test_query_timeout_fails_the_query (standin, standin_database):
+    """A query held past 'query_timeout' fails instead of waiting for the answer."""
+    standin_database.query_timeout = 0.3
+    standin.timeout_rate = 1.0
+
+    started = time.monotonic ()
+    assert not standin_database.reload_reference_data ()
+    assert time.monotonic () - started < standin.timeout_delay
+    assert failures (standin_database, "institutions") == 1
+
+def test_latency_within_the_timeout_succeeds (standin, standin_database):
+    """Latency below 'query_timeout' only slows queries down."""
+    standin_database.query_timeout = 1.0
+    standin.latency = 0.05
+    assert standin_database.reload_reference_data ()
+
+def test_pooled_store_raises_timeout_error_at_the_deadline (standin):
+    """The pooled store raises TimeoutError when a request runs past its deadline."""
+    store = connection_pool.PooledSPARQLUpdateStore (query_endpoint  = standin.url,
+                                                     update_endpoint = standin.url,
+                                                     returnFormat    = "json",
+                                                     method          = "POST")
+    try:
+        standin.latency = 0.5
+        store.set_deadline (time.monotonic () + 0.1)
+        with pytest.raises (TimeoutError):
+            store.query (QUERY)
+
+        store.set_deadline (time.monotonic () - 1)
+        queries = standin.statistics["queries"]
+        with pytest.raises (TimeoutError):
+            store.query (QUERY)
+        assert standin.statistics["queries"] == queries
+    finally:
+        store.close ()
+
+@pytest.mark.parametrize ("failure", ["503", "refused"])
+def test_read_endpoint_failover (standin, failure):
+    """A failing read endpoint is marked down and skipped for its cool-down."""
+    replica = None
+    if failure == "503":
+        replica = sparql_standin.StandinSparqlServer (port=0)
+        replica.error_rate = 1.0
+        replica.start ()
+        replica_url = replica.url
+    else:
+        replica_url = unused_url ()
+
+    balancer = connection_pool.ReadEndpointBalancer ([replica_url], standin.url,
+                                                     cool_down=60.0, replica_lag=0)
+    store = connection_pool.PooledSPARQLUpdateStore (query_endpoint  = standin.url,
+                                                     update_endpoint = standin.url,
+                                                     read_balancer   = balancer,
+                                                     returnFormat    = "json",
+                                                     method          = "POST")
+    try:
+        assert balancer.candidates () == [replica_url, standin.url]
+        store.query (QUERY)
+        assert balancer.candidates () == [standin.url]
+        store.query (QUERY)
+        assert standin.statistics["queries"] == 2
+        if replica is not None:
+            assert replica.statistics["injected_errors"] == 1
+    finally:
+        store.close ()
+        if replica is not None:
+            replica.stop ()